@@ -0,0 +1,164 @@
+'''
+Writing the zip file of the epub.
+
+The members are compressed according to their media type: text is
+deflated, images and other formats which are compressed already are
+stored. With jobs > 1 the compression runs in a pool of threads (zlib
+releases the GIL) while the next members are produced, and the
+compressed members are appended to the zip file in the order they were
+added.
+
+Generated members can be written with add_stream() from an iterable of
+chunks, which are deflated into the zip file as they come.
+'''
+
+import mimetypes
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# media types which are compressed already and gain nothing from deflate
+STORED_TYPES = {
+    'image/gif', 'image/jpeg', 'image/png', 'image/webp',
+    'font/woff', 'font/woff2', 'application/zip', 'application/epub+zip',
+}
+
+# bytes collected from the chunks of add_stream() before they are compressed
+STREAM_BUFFER = 1 << 16
+
+def compression(name, level):
+    '''the zipfile compression type for the member name'''
+    if level == 0 or mimetypes.guess_type(name)[0] in STORED_TYPES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def compress(data, compress_type, level):
+    '''return the crc, the compression type and the compressed data'''
+    crc = zlib.crc32(data)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) < len(data):
+            return crc, compress_type, compressed
+    return crc, zipfile.ZIP_STORED, data
+
+# 1980-01-01 00:00 UTC, the earliest date a zip file can store
+ZIP_EPOCH = 315532800
+
+class ArchiveWriter:
+    '''
+    if timestamp (seconds since the epoch) is given, all members are
+    dated to it (in UTC) instead of the current local time, so the same
+    members give the same zip file
+    '''
+    def __init__(self, name, level=6, jobs=1, timestamp=None):
+        self.archive = zipfile.ZipFile(name, 'w')
+        self.level = level
+        self.date_time = None
+        if timestamp is not None:
+            self.date_time = time.gmtime(max(timestamp, ZIP_EPOCH))[:6]
+        self.pool = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+        # members being compressed, at most 2 * jobs are kept in memory
+        self.pending = deque()
+        self.max_pending = 2 * jobs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, name, data, compress_type=None):
+        '''add the member name with the str or bytes data'''
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if compress_type is None:
+            compress_type = compression(name, self.level)
+        zinfo = self.zipinfo(name)
+        zinfo.file_size = len(data)
+        if self.pool is None:
+            self.append(zinfo, *compress(data, compress_type, self.level))
+            return
+        self.pending.append((zinfo, self.pool.submit(compress, data, compress_type, self.level)))
+        while len(self.pending) >= self.max_pending:
+            self.append_next()
+
+    def add_stream(self, name, chunks, compress_type=None):
+        '''
+        add the member name with the content of the iterable of str or bytes
+        chunks. with jobs > 1 the chunks are joined and compressed in the
+        pool like the data of add(), otherwise they are deflated into the
+        zip file as they come. content shorter than STREAM_BUFFER is added
+        with add() in any case, so a small member is stored if deflate does
+        not pay off, the same with any number of jobs.
+        '''
+        chunks = (chunk.encode('utf-8') if isinstance(chunk, str) else chunk for chunk in chunks)
+        if self.pool is not None:
+            self.add(name, b''.join(chunks), compress_type)
+            return
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_BUFFER:
+                break
+        else:
+            self.add(name, b''.join(buffer), compress_type)
+            return
+        if compress_type is None:
+            compress_type = compression(name, self.level)
+        while self.pending:
+            self.append_next()
+        zinfo = self.zipinfo(name)
+        zinfo.compress_type = compress_type
+        zinfo._compresslevel = self.level
+        with self.archive.open(zinfo, 'w') as member:
+            member.write(b''.join(buffer))
+            buffer.clear()
+            size = 0
+            for chunk in chunks:
+                buffer.append(chunk)
+                size += len(chunk)
+                if size >= STREAM_BUFFER:
+                    member.write(b''.join(buffer))
+                    buffer.clear()
+                    size = 0
+            member.write(b''.join(buffer))
+
+    def zipinfo(self, name):
+        zinfo = zipfile.ZipInfo(name, date_time=self.date_time or time.localtime(time.time())[:6])
+        # unix permissions on every platform (ZipInfo makes it 0 on windows)
+        zinfo.create_system = 3
+        zinfo.external_attr = 0o600 << 16
+        return zinfo
+
+    def append_next(self):
+        zinfo, future = self.pending.popleft()
+        self.append(zinfo, *future.result())
+
+    def append(self, zinfo, crc, compress_type, compressed):
+        '''append a compressed member, like ZipFile._open_to_write and _ZipWriteFile.close do'''
+        archive = self.archive
+        assert zinfo.file_size < zipfile.ZIP64_LIMIT and len(compressed) < zipfile.ZIP64_LIMIT
+        zinfo.compress_type = compress_type
+        zinfo.compress_size = len(compressed)
+        zinfo.CRC = crc
+        archive.fp.seek(archive.start_dir)
+        zinfo.header_offset = archive.fp.tell()
+        archive._writecheck(zinfo)
+        archive._didModify = True
+        archive.fp.write(zinfo.FileHeader(False))
+        archive.fp.write(compressed)
+        archive.start_dir = archive.fp.tell()
+        archive.filelist.append(zinfo)
+        archive.NameToInfo[zinfo.filename] = zinfo
+
+    def close(self):
+        while self.pending:
+            self.append_next()
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.archive.close()
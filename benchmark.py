@@ -0,0 +1,238 @@
+'''
+Benchmarks of the epub build on synthetic books.
+
+The build needs the downloaded book, so the benchmarks generate books in
+the shape of the MIT pages instead: a chain of book-Z-H-N.html pages
+linked by "next" navigation, chapters with epigraph tables, %_sec_
+anchors and headings, paragraphs with book-Z-G-D-N.gif formula images,
+figures and index anchors. At scale 1 the book has about as many pages
+as the real one, scale 10 has ten times as many and so on.
+
+The books are generated once into the corpus directory. Every stage of
+the build is timed with profiling.Profiler, the best time of the repeated
+runs is reported and can be stored as a baseline to compare later runs
+with:
+
+    python benchmark.py --scale 1 10 --save-baseline baseline.json
+    python benchmark.py --scale 1 10 --baseline baseline.json
+
+The comparison exits with status 1 if a stage got slower than allowed
+by --tolerance.
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import PIL.Image
+import make_epub
+from profiling import Profiler
+
+PAGES = 40
+# part of the corpus directory names, change it when generate() changes
+CORPUS_VERSION = 2
+STAGES = ['list_content', 'make_xml', 'replace_resources', 'split pages', 'toc', 'write toc.ncx',
+          'write toc.xhtml', 'write', 'total']
+
+DOCTYPE = ('<!doctype html public "-//W3C//DTD HTML 4.0 Transitional//EN" '
+           '"http://www.w3.org/TR/REC-html40/loose.dtd">')
+
+def navigation(n, last):
+    previous = 'book.html' if n == 1 else f'book-Z-H-{n-1}.html'
+    next_ = '' if n == last else f'<span>, <a href="book-Z-H-{n+1}.html">next</a></span>'
+    return (f'<div align=left><div class=navigation>[Go to <span><a href="book.html">first</a>, '
+            f'<a href="{previous}">previous</a></span>{next_} page<span>; &nbsp;&nbsp;</span>'
+            f'<span><a href="book-Z-H-4.html#%_toc_start">contents</a></span>]</div><p></div>\n')
+
+def contents_page(sections):
+    out = ['<p><a name="%_toc_start"></a><h1 class=chapter><div class=chapterheading>&nbsp;</div>'
+           '<br>Contents</h1><p>\n']
+    for n, section in sections:
+        out.append(f'<p><a name="%_toc_%_sec_{section}"></a><a href="book-Z-H-{n}.html#%_sec_{section}" '
+                   f'class=tocsection>{section}&nbsp;&nbsp;Section {section}</a><br>\n')
+    return out
+
+def chapter_page(n, last, rnd):
+    chapter = n % 9 + 1
+    out = [f'<p><a name="%_chap_{n}"></a>\n<h1 class=chapter>\n<div class=chapterheading>'
+           f'<a href="book-Z-H-4.html#%_toc_%_chap_{n}" class=chapterheading>Chapter {n}</a></div><br>\n'
+           f'<a href="book-Z-H-4.html#%_toc_%_chap_{n}" class=chapter>Page ``{n}\'\' -- title</a></h1><p>\n',
+           '<p>\n<div align=right> \n<table width=60%><tr><td>\n<span class=epigraph>The acts of the mind -- '
+           'wherein it ``exerts\'\' its power.<p>\nJohn Locke, <em>An Essay</em> (1690)\n</span></td></tr></table>\n</div>\n']
+    index = 0
+    for s in range(1, rnd.randint(3, 6)):
+        section = f'{n}.{s}'
+        out.append(f'<p><a name="%_sec_{section}"></a>\n<h2><a href="book-Z-H-4.html#%_toc_%_sec_{section}">'
+                   f'{section}&nbsp;&nbsp;Section <tt>{section}</tt></a></h2><p>\n')
+        for ss in range(1, rnd.randint(1, 4)):
+            subsection = f'{section}.{ss}'
+            out.append(f'<p><a name="%_sec_{subsection}"></a>\n<h3><a href="book-Z-H-4.html#%_toc_%_sec_{subsection}">'
+                       f'{subsection}&nbsp;&nbsp;Subsection</a></h3><p>\n')
+            for _ in range(rnd.randint(4, 12)):
+                index += 1
+                formula = rnd.choice([3, 4, 6, 9, 13, 14, 15])
+                target = rnd.randint(5, last)
+                out.append(f'<p>Some text ``quoted\'\' -- and---dashes <a name="%_idx_{index}"></a>with '
+                           f'<tt>(+&nbsp;137&nbsp;349)</tt> <font size=-1>small</font> and a formula '
+                           f'<img src="book-Z-G-D-{formula}.gif" border="0"> see '
+                           f'<a href="book-Z-H-{target}.html#%_sec_{target}.1">section</a>.\n')
+                if rnd.random() < 0.3:
+                    out.append(f'<p><div align=left><img src="ch{chapter}-Z-G-{rnd.randint(1, 5)}.gif" border="0"></div><p>\n')
+                if rnd.random() < 0.1:
+                    out.append(f'<p><a name="%_fig_{index}"></a><p><div align=left><table width=100%><tr><td>'
+                               f'<img src="ch{chapter}-Z-G-{rnd.randint(1, 5)}.gif" border="0">\n</td></tr>'
+                               f'<caption align=bottom><div align=left><b>Figure {index}:</b>&nbsp;&nbsp;Tree -- '
+                               f'representation.</div></caption><tr><td>\n</td></tr></table></div><p>\n')
+                if rnd.random() < 0.05:
+                    out.append('<p><tt>(define&nbsp;(f&nbsp;x)&nbsp;--&nbsp;``x\'\')</tt><p>\n')
+    return out
+
+def page(n, last, rnd, sections):
+    out = [DOCTYPE, '<html>\n<!-- Generated from TeX source by tex2page, v 4o -->\n<head>\n<title>\nSICP\n</title>\n'
+           '<link rel="stylesheet" type="text/css" href="book-Z-C.css" title=default>\n</head>\n<body>\n',
+           navigation(n, last)]
+    if n == 2:
+        out.append('<p><img src="https://i.creativecommons.org/l/by-sa/4.0/88x31.png"> License.</p>\n')
+    if n == 4:
+        out.extend(contents_page(sections))
+    else:
+        out.extend(chapter_page(n, last, rnd))
+    out.append(navigation(n, last))
+    out.append('</body></html>\n')
+    return ''.join(out)
+
+def generate(root, pages, seed=1):
+    '''write a book of the given number of pages to root/book'''
+    rnd = random.Random(seed)
+    book = os.path.join(root, 'book')
+    os.makedirs(book, exist_ok=True)
+    sections = [(n, f'{n}.{s}') for n in range(5, pages + 1) for s in (1, 2)]
+    with open(os.path.join(book, 'book.html'), 'w') as f:
+        f.write(DOCTYPE + '<html><head><title>SICP</title><link rel="stylesheet" type="text/css" '
+                'href="book-Z-C.css" title=default></head><body><p><img src="cover.jpg" border="0"></p>'
+                '<div class=navigation><a href="book-Z-H-1.html">next</a></div></body></html>')
+    for n in range(1, pages + 1):
+        with open(os.path.join(book, f'book-Z-H-{n}.html'), 'w') as f:
+            f.write(page(n, pages, rnd, sections))
+    for chapter in range(1, 10):
+        for k in range(1, 6):
+            image = PIL.Image.new('P', (40 + 10 * k, 20 + 7 * k), k)
+            image.save(os.path.join(book, f'ch{chapter}-Z-G-{k}.gif'))
+    for k in range(1, 21):
+        PIL.Image.new('P', (8, 12), k).save(os.path.join(book, f'book-Z-G-D-{k}.gif'))
+    PIL.Image.new('RGB', (400, 579), (200, 30, 30)).save(os.path.join(book, 'cover.jpg'))
+    with open(os.path.join(book, 'book-Z-C.css'), 'w') as f:
+        f.write('body { color: black; }\n')
+    new_content = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'new_content')
+    shutil.copytree(new_content, os.path.join(root, 'new_content'), dirs_exist_ok=True)
+
+def corpus(directory, scale, seed=1):
+    '''the directory of the book at the given scale, generated if it does not exist yet'''
+    root = os.path.join(directory, f'corpus-{CORPUS_VERSION}-{scale}x-{seed}')
+    if not os.path.exists(os.path.join(root, 'done')):
+        print(f'generating the {scale}x book in {root}')
+        generate(root, PAGES * scale, seed)
+        open(os.path.join(root, 'done'), 'w').close()
+    return root
+
+def run(root, parser='html5lib', jobs=1, low_memory=False):
+    '''build the book in root once, returning the seconds of every stage'''
+    cwd = os.getcwd()
+    profiler = Profiler()
+    with tempfile.TemporaryDirectory() as output:
+        os.chdir(root)
+        try:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                make_epub.build(os.path.join(output, 'sicp.epub'), parser=parser,
+                                jobs=jobs, low_memory=low_memory, profiler=profiler)
+            total = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    timings = {name: profiler.stats[name]['seconds'] for name in STAGES if name in profiler.stats}
+    timings['total'] = total
+    return timings
+
+def benchmark(scales, directory, repeat=3, seed=1, **options):
+    '''the best timings of repeat runs of the build for every scale'''
+    results = {}
+    for scale in scales:
+        root = corpus(directory, scale, seed)
+        best = {}
+        for _ in range(repeat):
+            for name, seconds in run(root, **options).items():
+                best[name] = min(seconds, best.get(name, seconds))
+        results[f'{scale}x'] = best
+    return results
+
+def compare(results, baseline, tolerance):
+    '''print the results next to the baseline and return the number of regressions'''
+    regressions = 0
+    print(f'{"scale":<6} {"stage":<20} {"seconds":>9} {"baseline":>9} {"change":>8}')
+    for scale, timings in results.items():
+        for name in STAGES:
+            if name not in timings:
+                continue
+            seconds = timings[name]
+            expected = baseline.get(scale, {}).get(name)
+            if expected is None:
+                print(f'{scale:<6} {name:<20} {seconds:>9.3f}')
+                continue
+            change = (seconds - expected) / expected if expected else 0.0
+            # very short stages are too noisy to count as regressions
+            regressed = change > tolerance and seconds - expected > 0.01
+            regressions += regressed
+            print(f'{scale:<6} {name:<20} {seconds:>9.3f} {expected:>9.3f} {change:>+8.1%}'
+                  + ('  REGRESSION' if regressed else ''))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the epub build on synthetic books.')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10],
+        help=f'sizes of the books in multiples of {PAGES} pages (default: 1 10)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='runs per book, the best time is reported (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1,
+        help='seed of the generated books (default: %(default)s)')
+    parser.add_argument('--corpus', default='.benchmark',
+        help='directory for the generated books (default: %(default)s)')
+    parser.add_argument('--parser', choices=['html5lib', 'lxml'], default='html5lib',
+        help='parser backend of the build (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='worker processes of the build (default: %(default)s)')
+    parser.add_argument('--low-memory', action='store_true',
+        help='build in low memory mode')
+    parser.add_argument('--baseline', metavar='FILE',
+        help='compare with the timings stored in FILE')
+    parser.add_argument('--save-baseline', metavar='FILE',
+        help='store the timings in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help='allowed slowdown against the baseline (default: %(default)s)')
+    args = parser.parse_args()
+
+    results = benchmark(args.scale, os.path.abspath(args.corpus), repeat=args.repeat,
+                        seed=args.seed, parser=args.parser, jobs=args.jobs,
+                        low_memory=args.low_memory)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'parser': args.parser, 'jobs': args.jobs, 'results': results},
+                      f, indent=2, sort_keys=True)
+    if regressions:
+        print(f'{regressions} stages are slower than the baseline')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
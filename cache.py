@@ -0,0 +1,112 @@
+'''
+An on-disk cache for build products, e.g. transformed pages.
+
+Entries are stored as pickle files named by their key in the cache
+directory. Reading an entry marks it as recently used (by touching the
+file), evict() removes the least recently used entries until the cache
+is below its size limit.
+
+MemoryCache keeps the entries of the last build in memory, in front of
+an on-disk cache, for the builds of make_epub.py --watch.
+'''
+
+import hashlib
+import os
+import pickle
+
+class BuildCache:
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        '''return the key for an entry depending on the given str or bytes parts'''
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            digest.update(len(part).to_bytes(8, 'little'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        '''return the cached object or None'''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        with open(path + '.part', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.part', path)
+
+    def evict(self):
+        '''remove least recently used entries until the cache fits in max_size'''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+class MemoryCache:
+    '''
+    the entries used since the last evict() in memory, in front of the
+    BuildCache cache (if it is not None)
+    '''
+    key = staticmethod(BuildCache.key)
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.directory = None if cache is None else cache.directory
+        self.entries = {}
+        self.used = set()
+
+    def __contains__(self, key):
+        return key in self.entries or (self.cache is not None and key in self.cache)
+
+    def get(self, key):
+        '''return the cached object or None'''
+        value = self.entries.get(key)
+        if value is None and self.cache is not None:
+            value = self.cache.get(key)
+        if value is not None:
+            self.entries[key] = value
+            self.used.add(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.used.add(key)
+        if self.cache is not None:
+            self.cache.put(key, value)
+
+    def evict(self):
+        '''drop the entries not used since the last call from memory'''
+        self.entries = {key: value for key, value in self.entries.items() if key in self.used}
+        self.used = set()
+        if self.cache is not None:
+            self.cache.evict()
@@ -2,17 +2,35 @@
 This script downloads the full text and saves it locally.
 referenced stylesheets and images are also downloaded.
 
-Care is taken to avoid more than 1 request/second and
-to avoid downloading files which are already available locally.
+Pages and their resources are fetched by a pool of worker threads.
+Care is taken not to overload the server: all requests to a host pass
+through a token bucket (by default 1 request/second) and the number of
+requests in flight is capped by the number of workers.
+Files which are already available locally are not downloaded again,
+unless --refresh is given: then every resource is requested with the
+ETag/Last-Modified recorded in the crawl manifest, so unchanged resources
+cost only a 304 response and only changed files are rewritten.
+
+The crawl frontier (the queue of pages and resources still to be fetched
+and the set of urls already done) is checkpointed to a state file, so an
+interrupted crawl resumes where it stopped when started again.
 
 local directory './book' needs to exist, it is not created automatically on purpose.
 '''
 
 import urllib.request
+import urllib.parse
+import urllib.error
+import hashlib
+import json
 import time
 import os
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from html.parser import HTMLParser
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urldefrag
 
 BASE_URL = 'https://mitpress.mit.edu/sites/default/files/sicp/full-text/'
 START_URL = BASE_URL + 'book/book.html'
@@ -24,31 +42,143 @@ def to_local(url):
     else:
         return None
 
-def download(url, name):
+class RateLimiter:
+    '''
+    A token bucket: tokens are refilled at `rate` per second up to `burst`,
+    each request takes one token and waits until one is available.
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+def file_hash(name):
+    '''return the sha256 hex digest of the local file'''
+    digest = hashlib.sha256()
+    with open(name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Manifest:
+    '''
+    The crawl manifest records for every downloaded url the local name,
+    the ETag and Last-Modified headers sent by the server, the size and
+    the sha256 hash of the content. It is stored as a json file.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def get(self, url):
+        with self.lock:
+            return self.entries.get(url)
+
+    def update(self, url, **entry):
+        with self.lock:
+            self.entries[url] = entry
+
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            data = json.dumps(self.entries, indent=1, sort_keys=True)
+        with open(self.filename + '.part', 'w') as f:
+            f.write(data)
+        os.replace(self.filename + '.part', self.filename)
+
+def conditional_headers(entry, name):
+    '''return the headers for a conditional GET of a resource we already have
+
+        the validators are only used if the local file still has the
+        recorded content, otherwise the resource is fetched in full.
+    '''
+    if entry is None or entry.get('name') != name or not os.path.exists(name):
+        return {}
+    if os.path.getsize(name) != entry.get('size') or file_hash(name) != entry.get('sha256'):
+        return {}
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def download(url, name, limiter=None, manifest=None, refresh=False):
     '''download the resource at url and save it under the given local name
 
-        if a local file already exists do nothing.
+        if a local file already exists do nothing, unless refresh is set:
+        then a conditional GET is made using the validators recorded in the
+        manifest and the file is only rewritten if its content changed.
+        the file is written under a temporary name first, so an interrupted
+        download does not leave a truncated file behind.
+
+        returns one of 'present', 'not modified', 'unchanged' or 'downloaded'
     '''
-    if os.path.exists(name):
+    exists = os.path.exists(name)
+    if exists and not refresh:
         #print(name, 'is already downloaded')
-        return
-    time.sleep(1.0)
-    page = urllib.request.urlopen(url)
-    with open(name, 'wb') as local:
-        local.write(page.read())
+        return 'present'
+    entry = manifest.get(url) if manifest is not None else None
+    request = urllib.request.Request(url, headers=conditional_headers(entry, name))
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        page = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as err:
+        if err.code == 304:
+            return 'not modified'
+        raise
+    with page:
+        data = page.read()
+        etag = page.headers.get('ETag')
+        last_modified = page.headers.get('Last-Modified')
+    sha256 = hashlib.sha256(data).hexdigest()
+    if exists and os.path.getsize(name) == len(data) and file_hash(name) == sha256:
+        result = 'unchanged'
+    else:
+        with open(name + '.part', 'wb') as local:
+            local.write(data)
+        os.replace(name + '.part', name)
+        result = 'downloaded'
+    if manifest is not None:
+        manifest.update(url, name=name, etag=etag, last_modified=last_modified,
+                        size=len(data), sha256=sha256)
+    return result
 
 class FindChildren(HTMLParser):
     '''
     A HTMLParser subclass to find related resources to download.
 
-    while parsing, two sets are filled:
+    while parsing, three sets are filled:
         self.download_only: urls of stylesheets and images
         self.follow: urls of html pages to follow (currently the "next" link only)
+        self.links: urls of all links
     '''
     def __init__(self):
         HTMLParser.__init__(self)
         self.download_only = set()
         self.follow = set()
+        self.links = set()
         self.data = None
 
     def handle_starttag(self, tag, attrs):
@@ -57,6 +187,8 @@ class FindChildren(HTMLParser):
             self.download_only.add(attrs['src'])
         if tag == 'a':
             self.a_href = attrs.get('href')
+            if self.a_href:
+                self.links.add(self.a_href)
         if tag == 'link':
             if attrs['rel'] == 'stylesheet':
                 self.download_only.add(attrs['href'])
@@ -72,32 +204,224 @@ class FindChildren(HTMLParser):
         self.data = data.strip()
         #print("Encountered some data  :", data)
 
+class Frontier:
+    '''
+    The work queue of a crawl.
+
+    Items are (url, name, is_page) tuples. They are handed out in the order
+    they were added (so pages are discovered breadth first) and every url
+    is only ever added once. Finished urls are recorded in self.visited.
+
+    The frontier can be saved to and restored from a json file; items which
+    were handed out but not finished are put back in front of the queue.
+    '''
+    def __init__(self):
+        self.queue = deque()
+        self.in_flight = {}
+        self.visited = set()
+        self.seen = set()
+
+    @classmethod
+    def load(cls, filename):
+        frontier = cls()
+        with open(filename) as f:
+            state = json.load(f)
+        frontier.visited = set(state['visited'])
+        frontier.seen = set(frontier.visited)
+        for item in state['queue']:
+            frontier.add(*item)
+        return frontier
+
+    def save(self, filename):
+        state = {
+            'queue': [list(item) for item in self.in_flight.values()] +
+                     [list(item) for item in self.queue],
+            'visited': sorted(self.visited),
+        }
+        with open(filename + '.part', 'w') as f:
+            json.dump(state, f)
+        os.replace(filename + '.part', filename)
+
+    def add(self, url, name, is_page):
+        if url in self.seen:
+            return
+        self.seen.add(url)
+        self.queue.append((url, name, is_page))
+
+    def pop(self):
+        item = self.queue.popleft()
+        self.in_flight[item[0]] = item
+        return item
+
+    def done(self, url):
+        del self.in_flight[url]
+        self.visited.add(url)
+
+    def __bool__(self):
+        return bool(self.queue or self.in_flight)
+
+class Crawler:
+    '''
+    Crawl the book starting from a page, following the links found by FindChildren.
+
+    Pages and resources are downloaded by a pool of `workers` threads,
+    so the stylesheets and images of a page are fetched while the next
+    page is already being downloaded. Requests to each host are limited
+    to `rate` per second (allowing bursts of `burst` requests).
+
+    If `refresh` is set, resources which exist locally are revalidated
+    against the server using the validators recorded in `manifest`.
+
+    Only the "next" link of each page is followed, unless `follow_all` is
+    set: then every linked html page below BASE_URL is crawled.
+
+    If a `state` filename is given, the frontier is checkpointed to it at
+    most every `checkpoint` seconds and when the crawl is interrupted.
+    A crawl started with an existing state file resumes from it, the file
+    is removed when the crawl completes.
+    '''
+    def __init__(self, rate=1.0, burst=1, workers=4, manifest=None, refresh=False,
+                 follow_all=False, state=None, checkpoint=5.0):
+        self.rate = rate
+        self.burst = burst
+        self.workers = workers
+        self.manifest = manifest if manifest is not None else Manifest(None)
+        self.refresh = refresh
+        self.follow_all = follow_all
+        self.state = state
+        self.checkpoint = checkpoint
+        self.limiters = {}
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def limiter(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter(self.rate, self.burst)
+            return self.limiters[host]
+
+    def download(self, url, name):
+        result = download(url, name, self.limiter(url), self.manifest, self.refresh)
+        with self.lock:
+            self.results[result] = self.results.get(result, 0) + 1
+        if result == 'downloaded' and self.refresh:
+            print('updated', url)
+
+    def fetch(self, url, name):
+        self.download(url, name)
+        return []
+
+    def process(self, url, name):
+        ''' download the page at url and return the pages and resources it refers to
+            as a list of (url, name, is_page) tuples
+        '''
+        print('processing', url)
+        self.download(url, name)
+        parser = FindChildren()
+        with open(name) as f:
+            parser.feed(f.read())
+        children = []
+        for ref in parser.download_only:
+            absref = urljoin(url, ref)
+            #print(' ->', absref)
+            local = to_local(absref)
+            if local is None:
+                print('not downloading', ref, absref)
+            else:
+                children.append((absref, local, False))
+        if len(parser.follow) > 1:
+            print('Multiple successors found')
+        follow = parser.follow
+        if self.follow_all:
+            follow = follow | {ref for ref in parser.links
+                               if urldefrag(urljoin(url, ref)).url.endswith('.html')}
+        for ref in follow:
+            absref = urldefrag(urljoin(url, ref)).url
+            #print(' ->>', absref)
+            local = to_local(absref)
+            if local is None:
+                print('not processing', absref)
+            else:
+                children.append((absref, local, True))
+        return children
+
+    def submit(self, pool, url, name, is_page):
+        if is_page:
+            return pool.submit(self.process, url, name)
+        else:
+            return pool.submit(self.fetch, url, name)
+
+    def save(self, frontier):
+        self.manifest.save()
+        if self.state:
+            frontier.save(self.state)
+
+    def crawl(self, url):
+        if self.state and os.path.exists(self.state):
+            frontier = Frontier.load(self.state)
+            print(f'resuming crawl: {len(frontier.visited)} done, {len(frontier.queue)} queued')
+        else:
+            name = to_local(url)
+            if name is None:
+                print('not processing', url)
+                return
+            frontier = Frontier()
+            frontier.add(url, name, True)
+        last_save = time.monotonic()
+        pending = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while frontier:
+                    while frontier.queue and len(pending) < self.workers:
+                        item = frontier.pop()
+                        pending[self.submit(pool, *item)] = item[0]
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        url = pending.pop(future)
+                        for child in future.result():
+                            frontier.add(*child)
+                        frontier.done(url)
+                    if time.monotonic() - last_save > self.checkpoint:
+                        self.save(frontier)
+                        last_save = time.monotonic()
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            self.save(frontier)
+            raise
+        self.manifest.save()
+        if self.state and os.path.exists(self.state):
+            os.remove(self.state)
+        print(', '.join(f'{count} {result}' for result, count in sorted(self.results.items())))
+
 def process(url):
     ''' download the resource at url and follow links as given by the
         FindChildren class
     '''
-    name = to_local(url)
-    if name is None:
-        print('not processing', url)
-        return
-    print('processing', url)
-    download(url, name)
-    parser = FindChildren()
-    parser.feed(open(name).read())
-    for ref in parser.download_only:
-        absref = urljoin(url, ref)
-        #print(' ->', absref)
-        local = to_local(absref)
-        if local is None:
-            print('not downloading', ref, absref)
-        else:
-            download(absref, local)
-    if len(parser.follow) > 1:
-        print('Multiple successors found')
-    for ref in parser.follow:
-        absref = urljoin(url, ref)
-        #print(' ->>', absref)
-        process(absref)
+    Crawler().crawl(url)
+
+def main():
+    parser = argparse.ArgumentParser(description='Download the book for local processing.')
+    parser.add_argument('--rate', type=float, default=1.0,
+        help='maximum number of requests per second and host (default: %(default)s)')
+    parser.add_argument('--burst', type=int, default=1,
+        help='number of requests allowed in a burst (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+        help='maximum number of concurrent requests (default: %(default)s)')
+    parser.add_argument('--manifest', default='download-manifest.json',
+        help='file recording the validators of downloaded resources (default: %(default)s)')
+    parser.add_argument('--refresh', action='store_true',
+        help='revalidate files which exist locally and update the ones which changed')
+    parser.add_argument('--follow-all', action='store_true',
+        help='crawl all linked pages instead of following the "next" links only')
+    parser.add_argument('--state', default='download-state.json',
+        help='checkpoint file of an unfinished crawl (default: %(default)s)')
+    args = parser.parse_args()
+    crawler = Crawler(rate=args.rate, burst=args.burst, workers=args.workers,
+                      manifest=Manifest(args.manifest), refresh=args.refresh,
+                      follow_all=args.follow_all, state=args.state)
+    crawler.crawl(START_URL)
 
 if __name__ == '__main__':
-    process(START_URL)
+    main()
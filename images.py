@@ -0,0 +1,95 @@
+'''
+The images of the book.
+
+ImageIndex holds the dimensions, format and hash of every image, so the
+pages can refer to them without opening the images again.
+
+GIF images are converted to optimized PNG images, which are usually
+smaller and supported by all epub readers. A converted image is only
+used if it has exactly the same pixels and is smaller than the original.
+'''
+
+import hashlib
+import io
+import json
+import os
+from collections import namedtuple
+import PIL
+import PIL.Image
+
+ImageInfo = namedtuple('ImageInfo', 'width, height, format, sha256')
+
+def image_info(data):
+    image = PIL.Image.open(io.BytesIO(data))
+    return ImageInfo(image.width, image.height, image.format, hashlib.sha256(data).hexdigest())
+
+class ImageIndex:
+    '''
+    The ImageInfo of the images of the book by media name.
+
+    If a sidecar file is given, the infos of images read from files are
+    stored in it together with the size and mtime of the file, and are
+    taken from there in the next build while the file is unchanged.
+    '''
+    def __init__(self, sidecar=None):
+        self.sidecar = sidecar
+        self.images = {}
+        self.files = {}
+        if sidecar is not None and os.path.exists(sidecar):
+            with open(sidecar) as f:
+                self.files = json.load(f)
+
+    def __getitem__(self, name):
+        return self.images[name]
+
+    def __contains__(self, name):
+        return name in self.images
+
+    def add(self, name, data):
+        '''add (or replace) the info of the image data under name'''
+        self.images[name] = image_info(data)
+
+    def build(self, media):
+        '''add the images of media, a dict of media.Medium by name'''
+        for name, med in media.items():
+            if not name.endswith(('.gif', '.png', '.jpg', '.jpeg')):
+                continue
+            if med.data is None and med.path is not None:
+                self.images[name] = self.file_info(med.path)
+            else:
+                self.images[name] = image_info(med.load())
+        if self.sidecar is not None:
+            with open(self.sidecar + '.part', 'w') as f:
+                json.dump(self.files, f, indent=1, sort_keys=True)
+            os.replace(self.sidecar + '.part', self.sidecar)
+
+    def file_info(self, path):
+        stat = os.stat(path)
+        entry = self.files.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return ImageInfo(*entry['info'])
+        with open(path, 'rb') as f:
+            info = image_info(f.read())
+        self.files[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'info': info}
+        return info
+
+# part of the cache keys of optimized images, change it when optimize() changes
+VERSION = f'png-optimize-1 PIL {PIL.__version__}'
+
+def pixels(image):
+    return image.convert('RGBA').tobytes()
+
+def optimize(data):
+    '''return the GIF image data as optimized PNG, or None if that does not pay off'''
+    original = PIL.Image.open(io.BytesIO(data))
+    if original.format != 'GIF' or getattr(original, 'n_frames', 1) > 1:
+        return None
+    original.load()
+    output = io.BytesIO()
+    original.save(output, 'PNG', optimize=True)
+    converted = output.getvalue()
+    if len(converted) >= len(data):
+        return None
+    if pixels(PIL.Image.open(io.BytesIO(converted))) != pixels(original):
+        return None
+    return converted
@@ -0,0 +1,75 @@
+'''
+An index of the ids and the references of all pages of the book.
+
+The ids and the references (href and src attributes) of every page are
+collected when the page is transformed. validate() then resolves all
+references in one pass over the index and reports the ones pointing to
+a file which is not in the book or to an id which does not exist in the
+target page.
+'''
+
+from collections import namedtuple
+from urllib.parse import urljoin, urlsplit
+
+PageLinks = namedtuple('PageLinks', 'ids, references')
+# a reference which can not be resolved: the page containing it, the tag
+# and url of the reference, and the reason
+Dangling = namedtuple('Dangling', 'page, tag, url, reason')
+
+class DanglingLinks(Exception):
+    def __init__(self, dangling):
+        super().__init__(f'{len(dangling)} links point to missing files or ids')
+        self.dangling = dangling
+
+def page_links(soup):
+    '''the PageLinks of a BeautifulSoup tree'''
+    ids = []
+    references = []
+    for tag in soup.find_all(True):
+        if tag.get('id') is not None:
+            ids.append(tag['id'])
+        for attr in ('href', 'src'):
+            if tag.get(attr) is not None:
+                references.append((tag.name, tag[attr]))
+    return PageLinks(ids, references)
+
+class LinkIndex:
+    def __init__(self):
+        # PageLinks by the name of the page in the book
+        self.pages = {}
+
+    def add(self, name, links):
+        self.pages[name] = links
+
+    def validate(self, media):
+        '''
+        resolve all references against the pages of the index and media,
+        the dict of media.Medium of the book (by their original names).
+        returns the list of Dangling references.
+        '''
+        names = {med.name for med in media.values()}
+        ids = {}
+        dangling = []
+        for page, links in self.pages.items():
+            ids[page] = set(links.ids)
+            if len(ids[page]) != len(links.ids):
+                seen = set()
+                for id_ in links.ids:
+                    if id_ in seen:
+                        dangling.append(Dangling(page, None, '#' + id_, 'duplicate id'))
+                    seen.add(id_)
+
+        for page, links in self.pages.items():
+            for tag, url in links.references:
+                target = urljoin(page, url)
+                path, _, fragment = target.partition('#')
+                if path in media:
+                    # the medium is renamed in the book, see Document.update_links
+                    path = media[path].name
+                elif path not in names:
+                    if not urlsplit(path).scheme:
+                        dangling.append(Dangling(page, tag, url, 'missing file'))
+                    continue
+                if fragment and path in ids and fragment not in ids[path]:
+                    dangling.append(Dangling(page, tag, url, 'missing id'))
+        return dangling
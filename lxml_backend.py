@@ -0,0 +1,369 @@
+'''
+Parse and transform pages with lxml instead of BeautifulSoup and html5lib.
+
+lxml parses with libxml2, which is much faster than html5lib, and the
+cleanup rules are applied directly to the lxml tree. The cleanup rules
+of make_epub are implemented here a second time for lxml elements, where
+text is not a node of its own but the .text or .tail of an element.
+
+The transformed tree is handed to the rest of the build in the flattened
+form of tree.py, so the later stages work unchanged.
+
+libxml2 builds a slightly different tree than html5lib for some markup
+(e.g. it closes a <p> before a <table>, where html5lib in quirks mode
+does not), so the output is not always identical to the html5lib build.
+make_epub.py --compare-parsers lists the pages where it differs.
+'''
+
+import re
+import lxml.html
+from lxml import etree
+from bs4 import Doctype, NavigableString
+import tree
+from links import PageLinks
+from profiling import Profiler
+
+# the same replacements as in make_epub.replace_inline_formula_images
+REPLACEMENTS = {
+    '3': 'Θ', '4': 'θ', '6': 'λ',
+    '9': 'π', '11': 'ϕ', '12': 'ψ',
+    '13': '√',
+    '14': '←', '15': '→', '16': '↑', '17': '↦',
+    '18': '⋮', '19': '∫', '20': '≈',
+}
+
+HEADER = re.compile(r'^h\d$')
+
+def parse(data):
+    '''parse the html page, returning the root element'''
+    root = lxml.html.document_fromstring(data)
+    insert_tbody(root)
+    return root
+
+def transform_page(data, profiler=None):
+    '''parse and transform the html page, returning a tree.PageResult'''
+    if profiler is None:
+        profiler = Profiler()
+    with profiler.stage('parse: lxml'):
+        root = parse(data)
+    with profiler.stage('lxml: transform'):
+        toc = transform(root)
+        normalize_whitespace(root, data)
+    with profiler.stage('lxml: flatten') as counter:
+        events = flatten(root)
+        counter['nodes'] += len(events)
+    return tree.PageResult(events, toc, page_links(root))
+
+def transform(root):
+    '''transform the tree in place, returning its table of contents entries'''
+    remove_comments(root)
+    for el in list(root.iter('tt')):
+        el.tag = 'code'
+    remove_obsolete_attributes(root)
+    for el in list(root.iter('font')):
+        el.drop_tag()
+    replace_inline_formula_images(root)
+    for el in list(root.iter('div')):
+        if 'navigation' in classes(el):
+            el.drop_tree()
+
+    for el in list(root.iter(etree.Element)):
+        if 'epigraph' in classes(el):
+            clean_epigraph_content(el)
+    for el in list(root.iter(etree.Element)):
+        if HEADER.match(el.tag):
+            clean_headers(el)
+    replace_quotes_and_dashes(root)
+
+    for el in list(root.iter('table')):
+        move_table_out_of_p_tag(el)
+    for el in list(root.iter('caption')):
+        div = el.find('.//div')
+        if div is not None:
+            div.drop_tag()
+        el.attrib.pop('align', None)
+    for el in list(root.iter('caption')):
+        table = el.getparent()
+        assert table.tag == 'table'
+        keep_tail(el)
+        el.tail = table.text
+        table.text = None
+        table.insert(0, el)
+
+    for el in list(root.iter('a')):
+        if '%_toc_%' in el.get('href', ''):
+            el.drop_tag()
+    anchor_name_to_id_and_deduplicate(root)
+    for el in list(root.iter('ul')):
+        move_anchors_from_ul_to_li(el)
+    toc = []
+    scans = {}
+    for el in list(root.iter(etree.Element)):
+        if HEADER.match(el.tag):
+            if el.getparent() not in scans:
+                scans[el.getparent()] = AnchorScan(el.getparent())
+            move_anchor_id_to_header(el, scans[el.getparent()])
+            if el.tag in ('h1', 'h2', 'h3'):
+                toc.append(toc_entry(el))
+    update_anchors_href(root)
+    for el in list(root.iter('p')):
+        if len(el) == 0 and not (el.text or '').strip():
+            el.drop_tree()
+    root.set('xmlns', 'http://www.w3.org/1999/xhtml')
+    return toc
+
+def classes(el):
+    return el.get('class', '').split()
+
+def keep_tail(el):
+    '''move the tail text of el to its previous sibling (or parent) before el is moved'''
+    if el.tail:
+        add_text_before(el, el.tail)
+        el.tail = None
+
+def add_text_before(el, text):
+    previous = el.getprevious()
+    if previous is not None:
+        previous.tail = (previous.tail or '') + text
+    else:
+        parent = el.getparent()
+        parent.text = (parent.text or '') + text
+
+def string(el):
+    '''the equivalent of Tag.string in BeautifulSoup'''
+    while len(el) == 1 and not el.text and not el[0].tail:
+        el = el[0]
+    return el.text if len(el) == 0 else None
+
+def insert_tbody(root):
+    '''wrap rows which are direct children of a table into tbody elements, like html5lib'''
+    for table in list(root.iter('table')):
+        tbody = None
+        for child in list(table):
+            if child.tag == 'tr':
+                if tbody is None:
+                    tbody = table.makeelement('tbody', {})
+                    child.addprevious(tbody)
+                tbody.append(child)
+            else:
+                tbody = None
+
+def remove_comments(root):
+    for el in list(root.iter(etree.Comment)):
+        el.drop_tree()
+
+def remove_obsolete_attributes(root):
+    for el in root.iter('div'):
+        el.attrib.pop('align', None)
+    for el in root.iter('td'):
+        el.attrib.pop('valign', None)
+    for el in root.iter('table'):
+        el.attrib.pop('width', None)
+        el.attrib.pop('border', None)
+    for el in root.iter('img'):
+        el.attrib.pop('border', None)
+
+def replace_inline_formula_images(root):
+    for el in list(root.iter('img')):
+        match = re.match(r'^book-Z-G-D-(\d+).gif$', el.get('src', ''))
+        if match:
+            add_text_before(el, REPLACEMENTS[match.group(1)] + (el.tail or ''))
+            el.tail = None
+            el.getparent().remove(el)
+
+def clean_epigraph_content(el):
+    div = el.getparent().getparent().getparent().getparent().getparent()
+    assert div.tag == 'div'
+    div.set('class', el.get('class'))
+    table = div.find('table')
+    el.drop_tag()
+    for cell in table.findall('tbody/tr/td'):
+        cell.drop_tag()
+    for row in table.findall('tbody/tr'):
+        row.drop_tag()
+    for body in table.findall('tbody'):
+        body.drop_tag()
+    table.drop_tag()
+
+def clean_headers(el):
+    for name in ('div', 'p', 'code'):
+        child = el.find('.//' + name)
+        if child is not None:
+            child.drop_tag()
+
+def replace_quotes_and_dashes(root):
+    def replace(text):
+        return (text.replace("''", '\u201d')
+                    .replace("``", '\u201c')
+                    .replace("---", '\u2014')
+                    .replace("--", '\u2013'))
+    code = set(root.iter('code'))
+    inside_code = set()
+    for el in code:
+        inside_code.update(el.iter())
+    for el in root.iter(etree.Element):
+        if el.text and el not in inside_code:
+            el.text = replace(el.text)
+        if el.tail and el.getparent() not in inside_code:
+            el.tail = replace(el.tail)
+
+def move_table_out_of_p_tag(el):
+    '''move all tables out of the p of el at once, see make_epub.move_table_out_of_p_tag'''
+    p_before = el.getparent()
+    if p_before.tag != 'p':
+        return
+    tables = []
+    following = []
+    for child in list(p_before):
+        if child.tag == 'table':
+            p_after = child.makeelement('p', {})
+            p_after.text = child.tail
+            child.tail = None
+            tables.append(child)
+            following.append(p_after)
+        elif following:
+            following[-1].append(child)
+    tables[0].tail = p_before.tail
+    p_before.tail = None
+    previous = p_before
+    for el in following + tables[::-1]:
+        previous.addnext(el)
+        previous = el
+
+def anchor_name_to_id_and_deduplicate(root):
+    ids = set()
+    for el in list(root.iter('a')):
+        if el.get('name') is not None:
+            new_id = el.get('name').replace('%', 'a')
+            if new_id in ids:
+                print('Duplicate ID', lxml.html.tostring(el, with_tail=False).decode())
+                el.drop_tree()
+            else:
+                el.set('id', new_id)
+                ids.add(new_id)
+                del el.attrib['name']
+
+def move_anchors_from_ul_to_li(ul):
+    li = None
+    for el in [child for child in ul if child.tag == 'a']:
+        if li is None:
+            li = ul.find('.//li')
+        keep_tail(el)
+        el.tail = li.text
+        li.text = None
+        li.insert(0, el)
+
+class AnchorScan:
+    '''
+    the anchors in front of the headings of one parent element, found in
+    one forward scan, see make_epub.AnchorScan. text is not a node here,
+    the text in front of an element is the tail of the one before it.
+    '''
+    def __init__(self, parent):
+        self.next = parent[0] if len(parent) else None
+        self.stops = []
+
+    def push_text(self, text):
+        if (text or '').strip():
+            self.stops.append((None, None))
+
+    def push(self, el):
+        if el.tag == 'a':
+            self.stops.append((el, el))
+        elif el.tag == 'p' and el.find('.//a') is not None:
+            self.stops.append((el, el.findall('.//a')[-1]))
+        elif (string(el) or '').strip():
+            self.stops.append((el, None))
+
+    def anchor(self, heading):
+        while self.next is not heading:
+            self.push(self.next)
+            self.push_text(self.next.tail)
+            self.next = self.next.getnext()
+        return self.stops[-1][1] if self.stops else None
+
+    def unwrap(self, anchor):
+        node, _ = self.stops.pop()
+        if node is anchor:
+            text, children = anchor.text, list(anchor)
+            anchor.drop_tag()
+            self.push_text(text)
+            for child in children:
+                self.push(child)
+                self.push_text(child.tail)
+        else:
+            anchor.drop_tag()
+            self.push(node)
+
+def move_anchor_id_to_header(el, scan):
+    anchor = scan.anchor(el)
+    if anchor is None:
+        print('Could not find anchor for', lxml.html.tostring(el, with_tail=False).decode())
+        return
+    id_ = anchor.get('id')
+    if id_ and (id_.startswith('a_chap') or id_.startswith('a_sec')):
+        el.set('id', id_)
+        scan.unwrap(anchor)
+    else:
+        print('Found anchor but no id', lxml.html.tostring(anchor, with_tail=False).decode())
+
+def update_anchors_href(root):
+    for el in root.iter('a'):
+        href = el.get('href')
+        if href is not None:
+            i = href.find('#')
+            if i == -1:
+                i = len(href)
+            href_new = href[:i].replace('.html', '.xhtml') + href[i:].replace('%', 'a')
+            if href_new != href:
+                el.set('href', href_new)
+
+def normalize_whitespace(root, data):
+    '''
+    put whitespace where html5lib puts it: there is no text before <head>
+    and the whitespace after </html> is appended to the body.
+    '''
+    root.text = None
+    head = root.find('head')
+    if head is not None and head.tail is not None and not head.tail.strip():
+        head.tail = '\n'
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    content = data.rstrip()
+    body = root.find('body')
+    if body is not None and content.lower().endswith('</html>') and content != data:
+        if len(body):
+            body[-1].tail = (body[-1].tail or '') + data[len(content):]
+        else:
+            body.text = (body.text or '') + data[len(content):]
+
+def toc_entry(el):
+    '''the (id, text, level) of the heading el'''
+    text = ' '.join(s.strip() for s in el.itertext() if s.strip())
+    return (el.get('id'), text, int(el.tag[1:]))
+
+def page_links(root):
+    '''the links.PageLinks of the page'''
+    ids = []
+    references = []
+    for el in root.iter(etree.Element):
+        if el.get('id') is not None:
+            ids.append(el.get('id'))
+        for attr in ('href', 'src'):
+            if el.get(attr) is not None:
+                references.append((el.tag, el.get(attr)))
+    return PageLinks(ids, references)
+
+def flatten(root):
+    '''return the events of tree.flatten for the lxml tree'''
+    events = [(tree.STRING, Doctype, 'html')]
+    for action, el in etree.iterwalk(root, events=('start', 'end')):
+        if action == 'start':
+            events.append((tree.TAG, el.tag, None, None, dict(el.attrib)))
+            if el.text:
+                events.append((tree.STRING, NavigableString, el.text))
+        else:
+            events.append(tree.END)
+            if el.tail and el is not root:
+                events.append((tree.STRING, NavigableString, el.tail))
+    return events
@@ -1,19 +1,42 @@
 import zipfile
 import os
 import mimetypes
-from datetime import datetime
+from datetime import datetime, timezone
 import uuid
 from html.parser import HTMLParser
 from urllib.parse import urljoin
 import re
-from bs4 import BeautifulSoup, Doctype, Comment
+from bs4 import BeautifulSoup, Doctype, Comment, Tag
 import sys
 import toc
 from media import Medium
 import configparser
-import PIL.Image
-
-sys.setrecursionlimit(3000)
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+import tempfile
+import time
+import traceback
+import glob
+from functools import partial
+import tree
+import rewrite
+import hashlib
+import difflib
+from itertools import repeat, zip_longest
+import bs4
+import html5lib
+import lxml.etree
+from cache import BuildCache, MemoryCache
+from archive import ArchiveWriter, ZIP_EPOCH
+from profiling import Profiler
+import lxml_backend
+import images
+from links import LinkIndex, DanglingLinks, page_links
+import validate
+import targets
+import minify
+import watch
 
 def relpath(arcname, base):
     a = arcname.split('/')
@@ -64,62 +87,103 @@ class FindChildren(HTMLParser):
         #print("Encountered some data  :", data)
 
 class Document:
-    def __init__(self, name):
+    def __init__(self, name, parser='html5lib', profiler=None, children=None, frozen=None):
         self.media = {}
+        # the keys of the media by their manifest id, see add_medium()
+        self.ids = {}
         self.spine = []
         self.book_uuid = uuid.uuid4()
+        # the time of the build in seconds since the epoch, None for the
+        # current time (see reproducible())
+        self.timestamp = None
+        self.parser = parser
+        self.profiler = profiler if profiler is not None else Profiler()
+        # functions(medium) making the last changes to a page, see write()
+        self.page_hooks = []
+        # filled by index_images()
+        self.images = images.ImageIndex()
+        # the ids and references of the pages, filled by make_xml()
+        self.links = LinkIndex()
+        # the toc.Toc of the pages, see add_toc()
+        self.toc = None
+        # the part of every id of the split pages by the names of all their
+        # parts, see split_pages()
+        self.split = {}
+        # the resources and the next page found in every page by its path,
+        # size and mtime, kept between builds by watch_build
+        self.children = children if children is not None else {}
+        # the pages of an earlier build, serialized after the page hooks,
+        # by the cache key of their source (see make_xml and watch_build)
+        self.frozen = frozen if frozen is not None else {}
+        # the cache keys of the sources of the pages by name, see make_xml
+        self.source_keys = {}
 
         self.title = 'Structure and Interpretation of Computer Programs, Second Edition'
 
-        self.list_content(name)
+        with self.profiler.stage('list_content'):
+            self.list_content(name)
 
     def list_content(self, name):
         while True:
-            med = Medium(name=name, data=open(name).read())
-            self.media[name] = med
+            # the files are read again when they are needed, see Medium.load
+            med = Medium(name=name, data=None, path=name, text=True)
+            self.add_medium(name, med)
             self.spine.append(med)
-            parser = FindChildren()
-            parser.feed(med.data)
-            for ref in parser.download_only:
+            stat = os.stat(name)
+            key = (name, stat.st_size, stat.st_mtime_ns)
+            if key not in self.children:
+                parser = FindChildren()
+                parser.feed(med.load())
+                self.children[key] = sorted(parser.download_only), sorted(parser.follow)
+            download_only, follow = self.children[key]
+            for ref in download_only:
                 absref = urljoin(name, ref)
                 if os.path.exists(absref):
-                    self.media[absref] = Medium(name=absref, data=open(absref, 'rb').read())
+                    self.add_medium(absref, Medium(name=absref, data=None, path=absref))
                 else:
                     print(f'WARNING: {absref} not found locally')
 
-            assert len(parser.follow) <= 1
-            if not parser.follow:
+            assert len(follow) <= 1
+            if not follow:
                 break
 
-            ref = parser.follow.pop()
+            ref = follow[0]
             name = urljoin(name, ref)
 
-    def content_opf(self):
+    def content_opf(self, version=3):
         AUTHOR = 'Harold Abelson and Gerald Jay Sussman with Julie Sussman'
         PUBLISHER = 'MIT Press'
         PUB_DATE = '1996-08-15'
         LANGUAGE = 'en-US'
-        modified = datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+        if self.timestamp is None:
+            modified = datetime.now()
+        else:
+            # the same date as the zip members, which can not be older
+            modified = datetime.fromtimestamp(max(self.timestamp, ZIP_EPOCH), timezone.utc)
+        modified = modified.strftime('%Y-%m-%dT%H:%M:%SZ')
+        # epub 2 has no modification date and no properties of items
+        modified = f'\n    <meta property="dcterms:modified">{modified}</meta>' if version >= 3 else ''
         metadata = f'''  <metadata>
     <dc:title>{self.title}</dc:title>
     <dc:creator>{AUTHOR}</dc:creator>
     <dc:identifier id="bookid">urn:uuid:{self.book_uuid}</dc:identifier>
     <dc:language>{LANGUAGE}</dc:language>
     <dc:date>{PUB_DATE}</dc:date>
-    <dc:publisher>{PUBLISHER}</dc:publisher>
-    <meta property="dcterms:modified">{modified}</meta>
+    <dc:publisher>{PUBLISHER}</dc:publisher>{modified}
     <meta name="cover" content="cover" />
   </metadata>'''
 
 
         items = []
-        for med in self.media.values():
+        for med in self.package_media(version):
             attrs = {
                 'href': med.name,
                 'id': med.id,
                 'media-type': mimetypes.guess_type(med.name)[0],
             }
             attrs.update(med.attributes)
+            if version < 3:
+                attrs.pop('properties', None)
             attrs=' '.join(f'{key}="{value}"' for key, value in attrs.items())
             items.append(f'    <item {attrs}/>')
 
@@ -131,25 +195,64 @@ class Document:
 
         spine = '  <spine toc="toc">\n' + '\n'.join(itemrefs) + '\n  </spine>'
 
+        lang = ' xml:lang="en"' if version >= 3 else ''
         return f'''<?xml version='1.0' encoding='utf-8'?>
-<package xmlns="http://www.idpf.org/2007/opf" xmlns:dc="http://purl.org/dc/elements/1.1/" xml:lang="en" unique-identifier="bookid" version="3.0">
+<package xmlns="http://www.idpf.org/2007/opf" xmlns:dc="http://purl.org/dc/elements/1.1/"{lang} unique-identifier="bookid" version="{version}.0">
 {metadata}
 {manifest}
 {spine}
 </package>'''
 
+    def source_digest(self):
+        '''the sha256 hex digest of the names and source files of the media'''
+        digest = hashlib.sha256()
+        for key in sorted(self.media):
+            med = self.media[key]
+            digest.update(med.name.encode('utf-8') + b'\0')
+            if med.path is not None:
+                with open(med.path, 'rb') as f:
+                    digest.update(f.read())
+            elif isinstance(med.data, (str, bytes)):
+                digest.update(med.data.encode('utf-8') if isinstance(med.data, str) else med.data)
+        return digest.hexdigest()
+
+    def reproducible(self, timestamp):
+        '''
+        make the output depend on the sources only: the book uuid is derived
+        from their digest and the modification date and the dates of the
+        zip members are timestamp (but not before 1980, see archive.ZIP_EPOCH)
+        '''
+        self.timestamp = timestamp
+        self.book_uuid = uuid.uuid5(uuid.NAMESPACE_URL, 'urn:sha256:' + self.source_digest())
+
+    def add_medium(self, key, med):
+        '''
+        add med to the media under key (replacing the medium there). the
+        manifest ids are derived from the names, ValueError is raised if
+        another medium has the id of med.
+        '''
+        other = self.media.get(self.ids.get(med.id))
+        if other is not None and other.id == med.id and self.ids[med.id] != key:
+            raise ValueError(f'{med.name} and {other.name} have the same id {med.id}')
+        self.media[key] = med
+        self.ids[med.id] = key
+
+    def package_media(self, version=3):
+        '''the media of the epub of the given version, epub 2 has no navigation document'''
+        return [med for med in self.media.values()
+                if version >= 3 or 'nav' not in med.attributes.get('properties', '').split()]
+
     def toc_entries(self):
         for med in self.spine:
-            soup = med.soup
-            for tag in soup.find_all(re.compile(r'^h[1-3]$')):
-                if tag.get('id'):
-                    text = ' '.join(tag.stripped_strings)
-                    yield toc.FlatTocInfo(med.name +'#' + tag['id'], text, int(tag.name[1:]))
+            for id_, text, level in med.toc:
+                if id_:
+                    yield toc.FlatTocInfo(med.name +'#' + id_, text, level)
                 else:
-                    print ('No ID for', tag)
+                    print ('No ID for', text)
 
     def set_cover(self, cover):
         self.media[cover].id = 'cover'
+        self.ids['cover'] = cover
         self.media[cover].attributes['properties'] = 'cover-image'
 
     def replace_resources(self):
@@ -162,19 +265,58 @@ class Document:
                 id_ = self.media[replaces].id
             else:
                 id_ = None
-            med = Medium(name=arcname,
-                data=open('new_content/'+fname,'rb').read(),
+            med = Medium(name=arcname, data=None,
+                path='new_content/'+fname,
                 id=id_)
             if med.name.endswith('html'):
-                med.soup = BeautifulSoup(med.data, 'html5lib')
-                med.data = None
-            self.media[replaces] = med
+                med.parsed(BeautifulSoup(med.load(), 'html5lib'))
+                self.links.add(med.name, page_links(med.soup))
+            self.add_medium(replaces, med)
+
+
+    def add_toc(self):
+        '''build the toc of the pages and add its ncx and nav documents to the media'''
+        with self.profiler.stage('toc'):
+            self.toc = toc.Toc()
+            for item in self.toc_entries():
+                self.toc.add(item)
+        for med in (self.toc.ncx(self), self.toc.xhtml(self)):
+            self.add_medium(med.name, med)
 
+    def freeze_pages(self):
+        '''
+        apply the page hooks to every page and keep only its serialization,
+        so the pages can be written more than once (see targets.write)
+        '''
+        for med in self.media.values():
+            if med.state == 'spilled':
+                with self.profiler.stage('restore spilled page'):
+                    med.restore()
+            if med.soup is not None:
+                for hook in self.page_hooks:
+                    with self.profiler.stage(hook.__name__):
+                        hook(med)
+                with self.profiler.stage('serialize'):
+                    med.drop_tree()
+
+    def write(self, name, level=6, jobs=1, version=3, rewrite_page=None, profiler=None):
+        '''
+        write the epub file. the functions in self.page_hooks are called with
+        every parsed page right before it is written; spilled pages are
+        restored one at a time for this and dropped from memory again.
 
-    def write(self, name):
-        with zipfile.ZipFile(name, 'w') as archive:
-            archive.writestr('mimetype', b'application/epub+zip')
-            archive.writestr('META-INF/container.xml',
+        the members are deflated at the given zlib level (0 stores all
+        of them) by jobs threads, see archive.ArchiveWriter.
+
+        version 2 writes an epub 2 package. rewrite_page(data) returns
+        the bytes to write for the serialized page data.
+        '''
+        profiler = self.profiler if profiler is None else profiler
+        if self.toc is None:
+            self.add_toc()
+        with ArchiveWriter(name, level=level, jobs=jobs, timestamp=self.timestamp) as archive:
+            archive.add('mimetype', b'application/epub+zip', zipfile.ZIP_STORED)
+            archive.add('META-INF/container.xml',
 '''<?xml version="1.0"?>
 <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
   <rootfiles>
@@ -182,78 +324,272 @@ class Document:
   </rootfiles>
 </container>
 ''')
-            mytoc = toc.Toc()
-            for item in self.toc_entries():
-                mytoc.add(item)
-            med = mytoc.ncx(self)
-            self.media[med.name] = med
-            med = mytoc.xhtml(self)
-            self.media[med.name] = med
-            content = self.content_opf()
-            archive.writestr('content.opf', content)
-            for med in self.media.values():
-                assert isinstance(med.get_data(), (str, bytes)), med
-                archive.writestr(med.name, med.get_data())
-
-    def make_xml(self):
-        for med in self.media.values():
-            if med.name.endswith('.html'):
-                print('transforming ', med.name)
-                med.name = med.name[:-5] + '.xhtml'
-
-                soup = BeautifulSoup(med.data, 'html5lib')
+            content = self.content_opf(version)
+            archive.add('content.opf', content)
+            for med in self.package_media(version):
+                if med.stream is not None:
+                    with profiler.stage(f'write {med.name}'):
+                        archive.add_stream(med.name, med.stream())
+                    continue
+                spilled = med.state == 'spilled'
+                if spilled:
+                    with profiler.stage('restore spilled page'):
+                        med.restore()
+                if med.soup is not None:
+                    for hook in self.page_hooks:
+                        with profiler.stage(hook.__name__):
+                            hook(med)
+                if rewrite_page is not None and med.name.endswith(PAGES):
+                    with profiler.stage('rewrite page'):
+                        data = rewrite_page(med.get_data())
+                    with profiler.stage('compress'):
+                        archive.add(med.name, data)
+                elif med.soup is not None:
+                    with profiler.stage('serialize and compress'):
+                        archive.add_stream(med.name, med.chunks())
+                else:
+                    data = med.get_data()
+                    assert isinstance(data, (str, bytes)), med
+                    with profiler.stage('compress'):
+                        archive.add(med.name, data)
+                if spilled:
+                    med.release()
+
+    def make_xml(self, jobs=1, cache=None, spill=None):
+        '''
+        parse and transform all html pages into xhtml.
 
-                rename_obsolete_tt_tag(soup)
-                remove_obsolete_attributes(soup)
-                remove_font_tag(soup)
-                replace_inline_formula_images(soup)
-                remove_navigation(soup)
-                remove_comments(soup)
+        with jobs > 1 the pages are transformed in parallel by a pool of
+        worker processes, which send back the transformed trees in the
+        compact form of tree.flatten.
 
-                clean_epigraph_content(soup)
-                clean_headers(soup)
-                replace_quotes_and_dashes(soup)
+        if a cache.BuildCache is given, pages which were transformed before
+        by the same version of the transformation are taken from the cache.
 
-                move_table_out_of_p_tag(soup)
-                clean_caption_tags(soup)
-                make_caption_first_child(soup)
+        self.parser selects the parser backend, see transform_page.
 
-                remove_toc_backlinks(soup)
-                anchor_name_to_id_and_deduplicate(soup)
-                move_anchors_from_ul_to_li(soup)
-                move_anchor_id_to_header(soup)
-                update_anchors_href(soup)
-                remove_empty_p_tag(soup)
+        if spill is a directory, the transformed pages are not kept in memory
+        but moved there (see Medium.spill), so only the page which is being
+        transformed is held as a tree.
 
-                for item in soup:
-                    if isinstance(item, Doctype):
-                        item.replace_with(Doctype('html'))
-                        break
+        pages found in self.frozen by their cache key are not built again,
+        they keep their serialization from the earlier build.
+        '''
+        pages = [med for med in self.media.values() if med.name.endswith('.html')]
+        keys = {}
+        if cache is not None:
+            version = transform_version(self.parser)
+            for med in pages:
+                keys[med.name] = cache.key(version, med.load())
+        self.source_keys = keys
+        todo = {med.name for med in pages if cache is None or keys[med.name] not in cache}
+
+        with ExitStack() as stack:
+            results = iter(())
+            if jobs > 1 and len(todo) > 1:
+                pool = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+                datas = [med.load() for med in pages if med.name in todo]
+                results = pool.map(transform_page, datas, repeat(self.parser), repeat(True))
+
+            for med in pages:
+                result = soup = None
+                if med.name in todo:
+                    print('transforming ', med.name)
+                    result = next(results, None)
+                else:
+                    print('transforming ', med.name, '(cached)')
+                    with self.profiler.stage('cache: get'):
+                        result = cache.get(keys[med.name])
+                if result is None and self.parser == 'html5lib':
+                    soup, toc_entries = parse_and_transform(med.load(), self.profiler)
+                    result = tree.PageResult(None, toc_entries, page_links(soup))
+                    if cache is not None or spill is not None:
+                        with self.profiler.stage('tree: flatten') as counter:
+                            result = result._replace(events=tree.flatten(soup))
+                            counter['nodes'] += len(result.events)
+                elif result is None:
+                    result = transform_page(med.load(), self.parser, profile=True)
+                if result.profile is not None:
+                    self.profiler.merge(result.profile)
+                    result = result._replace(profile=None)
+                if cache is not None and med.name in todo:
+                    with self.profiler.stage('cache: put'):
+                        cache.put(keys[med.name], result)
+                key = keys.get(med.name)
+                med.name = med.name[:-5] + '.xhtml'
+                if key in self.frozen:
+                    med.data = self.frozen[key]
+                elif spill is not None:
+                    with self.profiler.stage('spill'):
+                        med.spill(os.path.join(spill, med.id + '.pickle'), result.events)
+                elif soup is not None:
+                    med.parsed(soup)
+                else:
+                    with self.profiler.stage('tree: unflatten') as counter:
+                        med.parsed(tree.unflatten(result.events))
+                        counter['nodes'] += len(result.events)
+                med.toc = result.toc
+                self.links.add(med.name, result.links)
 
-                soup.html['xmlns'] = 'http://www.w3.org/1999/xhtml'
+        if cache is not None:
+            cache.evict()
 
-                med.data = None
-                med.soup = soup
+    def split_pages(self, max_size, spill=None):
+        '''
+        split the pages whose body is larger than about max_size bytes (see
+        tree.size) into parts (see split_page), which follow the page in the
+        spine. the links to the parts are changed by update_links.
 
-    def update_links(self):
+        spilled pages are restored for this one at a time and spilled to
+        the directory spill again with their parts.
+        '''
+        in_spine = {id(med) for med in self.spine}
+        # the parts of the split pages by their id
+        split = {}
+        for med in self.media.values():
+            if id(med) not in in_spine or not med.name.endswith('.xhtml'):
+                continue
+            spilled = med.state == 'spilled'
+            if spilled:
+                med.restore()
+            if med.soup is None:
+                continue
+            parts = self.split_page(med, max_size)
+            if parts:
+                print('splitting', med.name, 'into', len(parts) + 1, 'parts')
+                split[med.id] = parts
+                med.modified()
+                if spilled:
+                    for part in [med] + parts:
+                        part.spill(os.path.join(spill, part.id + '.pickle'))
+            elif spilled:
+                med.release()
+        if not split:
+            return
+        media = self.media
+        self.media = {}
+        self.ids = {}
+        for key, med in media.items():
+            self.add_medium(key, med)
+            for part in split.get(med.id, ()):
+                self.add_medium(part.name, part)
+        self.spine = [part for med in self.spine for part in [med] + split.get(med.id, [])]
+
+    def split_page(self, med, max_size):
+        '''
+        split the body of the page med at the h2 and h3 headings which are
+        its children into parts of at most max_size bytes, as far as the
+        sections allow. med keeps the first part, the media of the other
+        parts are returned (an empty list if the page is small enough).
+        '''
+        body = med.soup.body
+        if body is None or tree.size(body) <= max_size:
+            return []
+        children = list(body.contents)
+        sizes = [tree.size(child) for child in children]
+        # a section runs from a heading to the next one, sections are added
+        # to a part as long as it stays below max_size
+        headings = [i for i, child in enumerate(children)
+                    if i and isinstance(child, Tag) and child.name in ('h2', 'h3')]
+        starts = [0]
+        size = 0
+        for start, end in zip([0] + headings, headings + [len(children)]):
+            section = sum(sizes[start:end])
+            if start > starts[-1] and size + section > max_size:
+                starts.append(start)
+                size = 0
+            size += section
+        if len(starts) == 1:
+            return []
+
+        for i in reversed(range(len(children))):
+            children[i].extract(_self_index=i)
+        # the head and the empty body of the parts
+        skeleton = tree.flatten(med.soup)
+        stem = med.name[:-len('.xhtml')]
+        ends = starts[1:] + [len(children)]
+        parts = [med]
+        for n, (start, end) in enumerate(zip(starts, ends)):
+            if n == 0:
+                part = med
+            else:
+                part = Medium(name=f'{stem}-{n + 1}.xhtml', data=None)
+                part.parsed(tree.unflatten(skeleton))
+                parts.append(part)
+            part.soup.body.insert(0, *children[start:end])
+
+        ids = {}
+        for part in parts:
+            for tag in part.soup.body.find_all(id=True):
+                ids[tag['id']] = part.name
+        for part in parts:
+            self.split[part.name] = ids
+        # the toc entries go with their headings
+        entries = med.toc or []
+        tocs = {part.name: [] for part in parts}
+        name = med.name
+        for entry in entries:
+            name = ids.get(entry[0], name)
+            tocs[name].append(entry)
+        for part in parts:
+            part.toc = tocs[part.name]
+        return parts[1:]
+
+    def compare_parsers(self, jobs=1):
+        '''
+        transform all html pages with both parser backends and report the
+        pages where the output differs. returns the number of these pages.
+        '''
+        pages = [med for med in self.media.values() if med.name.endswith('.html')]
+        datas = [med.load() for med in pages]
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                reports = list(pool.map(compare_parsers, datas))
+        else:
+            reports = [compare_parsers(data) for data in datas]
+        differing = 0
+        for med, report in zip(pages, reports):
+            if report:
+                differing += 1
+                print(f'{med.name}:')
+                for line in report:
+                    print('   ', line)
+        print(f'{differing} of {len(pages)} pages differ between the html5lib and lxml parsers')
+        return differing
+
+    def update_links(self, med):
+        if med.name.endswith('.xhtml'):
+            print('updating links in ', med.name)
+            modified = False
+            soup = med.soup
+            for tag in soup.find_all('img'):
+                abs_src = urljoin(med.name, tag['src'])
+                referenced_media = self.media.get(abs_src)
+                if not referenced_media:
+                    print('no content for', abs_src)
+                    continue
+                if referenced_media.name != abs_src:
+                    new_src = relpath(referenced_media.name, med.name)
+                    print(tag['src'], '->', new_src)
+                    tag['src'] = new_src
+                    modified = True
+            # the links to ids which moved to another part of a split page
+            for tag in soup.find_all('a', href=True) if self.split else ():
+                path, _, fragment = urljoin(med.name, tag['href']).partition('#')
+                part = self.split.get(path, {}).get(fragment, path)
+                if part != path:
+                    new_href = ('' if part == med.name else relpath(part, med.name)) + '#' + fragment
+                    tag['href'] = new_href
+                    modified = True
+            if modified:
+                med.modified()
+
+    def minify_stylesheets(self):
+        '''replace the stylesheets by their minified text, see minify.css'''
         for med in self.media.values():
-            if med.name.endswith('.xhtml'):
-                print('updating links in ', med.name)
-                modified = False
-                soup = med.soup
-                for tag in soup.find_all('img'):
-                    abs_src = urljoin(med.name, tag['src'])
-                    referenced_media = self.media.get(abs_src)
-                    if not referenced_media:
-                        print('no content for', abs_src)
-                        continue
-                    if referenced_media.name != abs_src:
-                        new_src = relpath(referenced_media.name, med.name)
-                        print(tag['src'], '->', new_src)
-                        tag['src'] = new_src
-                        modified = True
-                if modified:
-                    med.data = soup.prettify()
+            if med.name.endswith('.css'):
+                data = med.load()
+                med.data = minify.css(data.decode('utf-8') if isinstance(data, bytes) else data)
 
     def remove_unused_images(self):
         to_remove = [x for x in self.media
@@ -261,215 +597,702 @@ class Document:
         for name in to_remove:
             del self.media[name]
 
-    def set_height_on_images(self):
+    def index_images(self, sidecar=None):
+        '''collect the dimensions of all images, see images.ImageIndex'''
+        self.images = images.ImageIndex(sidecar)
+        self.images.build(self.media)
+
+    def optimize_images(self, jobs=1, cache=None):
+        '''
+        replace the GIF images by optimized PNG images (see images.optimize),
+        in jobs worker processes. the images are renamed, update_links
+        changes the references to them. the image index is updated for the
+        new data, under the new name and under the original one (which the
+        pages refer to until update_links ran).
+
+        if a cache.BuildCache is given, images which were optimized before
+        are taken from the cache.
+        '''
+        gifs = [med for med in self.media.values() if med.name.endswith('.gif')]
+        sizes = {}
+        keys = {}
+        results = {}
+        todo = []
+        for med in gifs:
+            data = med.load()
+            sizes[med.name] = len(data)
+            if cache is not None:
+                keys[med.name] = cache.key(images.VERSION, data)
+                cached = cache.get(keys[med.name])
+                if cached is not None:
+                    results[med.name], = cached
+                    continue
+            todo.append((med, data))
+
+        datas = [data for _, data in todo]
+        if jobs > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                optimized = list(pool.map(images.optimize, datas))
+        else:
+            optimized = [images.optimize(data) for data in datas]
+        for (med, _), result in zip(todo, optimized):
+            results[med.name] = result
+            if cache is not None:
+                cache.put(keys[med.name], (result,))
+
+        saved = 0
+        for med in gifs:
+            png = results[med.name]
+            if png is not None:
+                saved += sizes[med.name] - len(png)
+                self.images.add(med.name, png)
+                med.name = med.name[:-4] + '.png'
+                med.data = png
+                self.images.add(med.name, png)
+        converted = sum(png is not None for png in results.values())
+        print(f'optimized {converted} of {len(gifs)} images ({len(todo)} not cached), saving {saved} bytes')
+
+    def set_height_on_images(self, med):
         '''
         The original images are rendered with an ex height of approx 6px
         If the image size is thus set to (height in image pixels)/6 ex-heights
         The rendered text in the image should approximately show in the same height
         as the surrounding text
+
+        the image sizes are taken from self.images, see index_images().
         '''
-        for med in self.media.values():
-            if med.soup:
-                for tag in med.soup.find_all('img',
-                        src=re.compile(r'^ch\d-Z-G-\d+.gif$')):
-                    abs_src = urljoin(med.name, tag['src'])
-                    image = PIL.Image.open(abs_src)
-                    height_in_pixels = image.size[1]
-                    height_in_ex = height_in_pixels * 0.16
-                    tag['style'] = f'height:{height_in_ex:0.2f}ex;'
-
-def rename_obsolete_tt_tag(soup):
-    for tag in soup.find_all('tt'):
-        tag.name = 'code'
-
-def remove_empty_p_tag(soup):
-    for tag in soup.find_all('p'):
-        is_empty = True
-        for x in tag.contents:
-            if x.name:
-                is_empty = False
-                break
-            elif x.strip():
-                is_empty = False
-                break
-        if is_empty:
-            tag.decompose()
-
-def anchor_name_to_id_and_deduplicate(soup):
-    ids = set()
-    for tag in soup.find_all('a'):
-        if 'name' in tag.attrs:
-            new_id = tag['name'].replace('%', 'a')
-            if new_id in ids:
-                print('Duplicate ID', tag)
-                tag.decompose()
-            else:
-                tag['id'] = new_id
-                ids.add(new_id)
-                del tag['name']
-
-def clean_caption_tags(soup):
-    for tag in soup.find_all('caption'):
-        if tag.div:
-            tag.div.unwrap()
-        del tag['align']
+        for tag in med.soup.find_all('img',
+                src=re.compile(r'^ch\d-Z-G-\d+.gif$')):
+            abs_src = urljoin(med.name, tag['src'])
+            height_in_pixels = self.images[abs_src].height
+            height_in_ex = height_in_pixels * 0.16
+            tag['style'] = f'height:{height_in_ex:0.2f}ex;'
+            med.modified()
+
+CLEANUP = rewrite.RuleSet()
+HEADER = re.compile(r'^h\d$')
+TOC_HEADER = re.compile(r'^h[1-3]$')
+# the names of the (x)html pages of the book
+PAGES = ('.xhtml', '.html')
+# the size in bytes above which a page is split, readers lay out a whole
+# file before they show its first page
+SPLIT_SIZE = 256 * 1024
+
+def parse_and_transform(data, profiler=None):
+    '''
+    parse the html page and transform it into an xhtml tree. returns the
+    tree and its table of contents entries (see collect_toc_entries).
+    '''
+    if profiler is None:
+        profiler = Profiler()
+    with profiler.stage('parse: html5lib'):
+        soup = BeautifulSoup(data, 'html5lib')
 
-def move_table_out_of_p_tag(soup):
-    for tag in soup.find_all('table'):
-        if tag.parent.name == 'p':
-            p_before = tag.parent
-            p_after = soup.new_tag('p')
-            for child in list(tag.next_siblings):
-                p_after.append(child)
-            p_before.insert_after(tag)
-            p_before.insert_after(p_after)
-
-def clean_headers(soup):
-    for tag in soup.find_all(re.compile(r'^h\d$')):
-        if tag.div:
-            tag.div.unwrap()
-        if tag.p:
-            tag.p.unwrap()
-        if tag.code:
-            tag.code.unwrap()
-
-def clean_epigraph_content(soup):
-    for tag in soup.find_all(**{'class': 'epigraph'}):
-        div = tag.parent.parent.parent.parent.parent
-        assert div.name == 'div'
-        #print('='*60)
-        #print(div)
-        div['class'] = tag['class']
-        div.table.tbody.tr.td.span.unwrap()
-        div.table.tbody.tr.td.unwrap()
-        div.table.tbody.tr.unwrap()
-        div.table.tbody.unwrap()
-        div.table.unwrap()
-        #print('-'*60)
-        #print(div)
-
-def make_caption_first_child(soup):
-    for tag in soup.find_all('caption'):
-        table = tag.parent
-        assert table.name == 'table'
-        table.insert(0, tag)
-
-def remove_font_tag(soup):
-    for tag in soup.find_all('font'):
-        tag.unwrap()
-
-def remove_toc_backlinks(soup):
-    for tag in soup.find_all('a', href=re.compile(r'%_toc_%')):
-        tag.unwrap()
-
-def update_anchors_href(soup):
-    for tag in soup.find_all('a'):
-        if 'href' in tag.attrs:
-            href = tag['href']
-            i = href.find('#')
-            if i == -1:
-                i = len(href)
-            href_new = href[:i].replace('.html', '.xhtml') + href[i:].replace('%', 'a')
-            if href_new != href:
-                #print(href, '->', href_new)
-                tag['href'] = href_new
-
-def remove_obsolete_attributes(soup):
-    for tag in soup.find_all('div'):
-        del tag['align']
+    context = CLEANUP.apply(soup, profiler)
 
-    for tag in soup.find_all('td'):
-        del tag['valign']
+    for item in soup:
+        if isinstance(item, Doctype):
+            item.replace_with(Doctype('html'))
+            break
 
-    for tag in soup.find_all('table'):
-        del tag['width']
-        del tag['border']
+    soup.html['xmlns'] = 'http://www.w3.org/1999/xhtml'
+    return soup, context.store.get('toc', [])
 
-    for tag in soup.find_all('img'):
-        del tag['border']
+def transform_page(data, parser='html5lib', profile=False):
+    '''
+    transform a page and return it as a tree.PageResult (this is also the
+    entry point of the worker processes).
 
+    parser is 'html5lib' (BeautifulSoup with the cleanup rules of this module)
+    or 'lxml' (the much faster implementation in lxml_backend).
 
-def replace_inline_formula_images(soup):
-    for tag in soup.find_all('img'):
-        match = re.match(r'^book-Z-G-D-(\d+).gif$', tag['src'])
-        if match:
-            REPLACEMENTS = {
-                '3': 'Θ', '4': 'θ', '6': 'λ',
-                '9': 'π', '11': 'ϕ', '12': 'ψ',
-                '13': '√',
-                '14': '←', '15': '→', '16': '↑', '17': '↦',
-                '18': '⋮', '19': '∫', '20': '≈',
-            }
-            tag.replace_with(REPLACEMENTS[match.group(1)])
+    with profile=True the profiling.Profiler stats of the transformation
+    are returned in the result.
+    '''
+    profiler = Profiler()
+    if parser == 'lxml':
+        result = lxml_backend.transform_page(data, profiler)
+    else:
+        soup, toc_entries = parse_and_transform(data, profiler)
+        with profiler.stage('tree: flatten') as counter:
+            events = tree.flatten(soup)
+            counter['nodes'] += len(events)
+        result = tree.PageResult(events, toc_entries, page_links(soup))
+    if profile:
+        result = result._replace(profile=profiler.stats)
+    return result
+
+def compare_parsers(data):
+    '''
+    transform the page with both parser backends and return a list of
+    lines describing the differences of the output (empty if there are none).
+    '''
+    reference = transform_page(data, 'html5lib')
+    candidate = transform_page(data, 'lxml')
+    expected = tree.markup(tree.unflatten(reference.events))
+    actual = tree.markup(tree.unflatten(candidate.events))
+    report = []
+    if expected != actual:
+        if expected.split() == actual.split():
+            report.append('output differs in whitespace only')
+        else:
+            diff = list(difflib.unified_diff(expected.splitlines(), actual.splitlines(),
+                'html5lib', 'lxml', n=0, lineterm=''))
+            report.extend(diff[:20])
+            if len(diff) > 20:
+                report.append(f'... {len(diff) - 20} more lines')
+    for expected, actual in zip_longest(reference.toc, candidate.toc):
+        if expected != actual:
+            report.append(f'toc entry differs: {expected} != {actual}')
+    return report
+
+def transform_version(parser='html5lib'):
+    '''
+    a hash of the code the transformed pages depend on, used in the keys of
+    cached pages so the cache is invalidated when the transformation changes.
+    '''
+    digest = hashlib.sha256()
+    modules = [sys.modules[__name__], rewrite, tree]
+    if parser == 'lxml':
+        modules.append(lxml_backend)
+    for module in modules:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    digest.update(parser.encode())
+    digest.update(bs4.__version__.encode())
+    digest.update(html5lib.__version__.encode())
+    digest.update(lxml.etree.__version__.encode())
+    return digest.hexdigest()
+
+@CLEANUP.rule('tt')
+def rename_obsolete_tt_tag(tag, context):
+    tag.name = 'code'
+
+@CLEANUP.rule('div', 'td', 'table', 'img')
+def remove_obsolete_attributes(tag, context):
+    if tag.name == 'div':
+        del tag['align']
+    elif tag.name == 'td':
+        del tag['valign']
+    elif tag.name == 'table':
+        del tag['width']
+        del tag['border']
+    elif tag.name == 'img':
+        del tag['border']
 
-def move_anchors_from_ul_to_li(soup):
-    for tag in soup.find_all('a'):
-        if tag.parent.name == 'ul':
-            tag.parent.li.insert(0, tag)
+@CLEANUP.rule('font')
+def remove_font_tag(tag, context):
+    tag.unwrap()
+
+@CLEANUP.rule('img')
+def replace_inline_formula_images(tag, context):
+    match = re.match(r'^book-Z-G-D-(\d+).gif$', tag['src'])
+    if match:
+        REPLACEMENTS = {
+            '3': 'Θ', '4': 'θ', '6': 'λ',
+            '9': 'π', '11': 'ϕ', '12': 'ψ',
+            '13': '√',
+            '14': '←', '15': '→', '16': '↑', '17': '↦',
+            '18': '⋮', '19': '∫', '20': '≈',
+        }
+        tag.replace_with(REPLACEMENTS[match.group(1)])
+
+@CLEANUP.rule('div', attrs={'class': 'navigation'})
+def remove_navigation(tag, context):
+    tag.decompose()
+
+@CLEANUP.rule(string=Comment)
+def remove_comments(tag, context):
+    tag.extract()
+
+@CLEANUP.rule(attrs={'class': 'epigraph'}, after=['remove_font_tag'])
+def clean_epigraph_content(tag, context):
+    div = tag.parent.parent.parent.parent.parent
+    assert div.name == 'div'
+    #print('='*60)
+    #print(div)
+    div['class'] = tag['class']
+    div.table.tbody.tr.td.span.unwrap()
+    div.table.tbody.tr.td.unwrap()
+    div.table.tbody.tr.unwrap()
+    div.table.tbody.unwrap()
+    div.table.unwrap()
+    #print('-'*60)
+    #print(div)
+
+@CLEANUP.rule(HEADER, after=['rename_obsolete_tt_tag'])
+def clean_headers(tag, context):
+    if tag.div:
+        tag.div.unwrap()
+    if tag.p:
+        tag.p.unwrap()
+    if tag.code:
+        tag.code.unwrap()
+
+@CLEANUP.rule(string=re.compile(r"''|``|--"),
+              after=['rename_obsolete_tt_tag', 'remove_comments', 'clean_headers'])
+def replace_quotes_and_dashes(tag, context):
+    if any(t.name == 'code' for t in tag.parents):
+        return
+    tag.replace_with(
+        tag.replace("''", '\u201d')
+           .replace("``", '\u201c')
+           .replace("---", '\u2014')
+           .replace("--", '\u2013')
+    )
+
+def extract_children(tag, start):
+    '''remove the children of tag from index start on and return them'''
+    # extracting from the end with the index known avoids a search of the
+    # contents for every child
+    children = [tag.contents[i].extract(_self_index=i)
+                for i in reversed(range(start, len(tag.contents)))]
+    children.reverse()
+    return children
+
+@CLEANUP.rule('table', after=['remove_font_tag', 'clean_epigraph_content'])
+def move_table_out_of_p_tag(tag, context):
+    '''
+    move all tables out of the p of tag at once: the p is split into new p
+    tags at the tables, followed by the tables in reverse order (as moving
+    out one table after the other does)
+    '''
+    p_before = tag.parent
+    if p_before.name != 'p':
+        return
+    first = next(i for i, child in enumerate(p_before.contents) if child.name == 'table')
+    tables = []
+    following = []
+    for child in extract_children(p_before, first):
+        if child.name == 'table':
+            tables.append(child)
+            following.append(context.soup.new_tag('p'))
+        else:
+            following[-1].append(child)
+    parent = p_before.parent
+    parent.insert(parent.index(p_before) + 1, *following, *reversed(tables))
+
+@CLEANUP.rule('caption')
+def clean_caption_tags(tag, context):
+    if tag.div:
+        tag.div.unwrap()
+    del tag['align']
+
+@CLEANUP.rule('caption')
+def make_caption_first_child(tag, context):
+    table = tag.parent
+    assert table.name == 'table'
+    table.insert(0, tag)
+
+@CLEANUP.rule('a', attrs={'href': re.compile(r'%_toc_%')})
+def remove_toc_backlinks(tag, context):
+    tag.unwrap()
+
+@CLEANUP.rule('a', attrs={'name': True}, fresh=True,
+              after=['remove_navigation', 'move_table_out_of_p_tag', 'make_caption_first_child'])
+def anchor_name_to_id_and_deduplicate(tag, context):
+    ids = context.store.setdefault('ids', set())
+    new_id = tag['name'].replace('%', 'a')
+    if new_id in ids:
+        print('Duplicate ID', tag)
+        tag.decompose()
+    else:
+        tag['id'] = new_id
+        ids.add(new_id)
+        del tag['name']
+
+@CLEANUP.rule('a', after=['anchor_name_to_id_and_deduplicate'])
+def move_anchors_from_ul_to_li(tag, context):
+    '''move all anchors of the ul of tag to its first li at once, the last one first'''
+    ul = tag.parent
+    if ul.name != 'ul':
+        return
+    li = ul.li
+    anchors = [ul.contents[i].extract(_self_index=i)
+               for i in reversed(range(len(ul.contents))) if ul.contents[i].name == 'a']
+    li.insert(0, *anchors)
+
+def string(node):
+    '''node.string, without recursion for deeply nested tags'''
+    while isinstance(node, Tag):
+        if len(node.contents) != 1:
+            return None
+        node = node.contents[0]
+    return node
+
+class AnchorScan:
+    '''
+    The anchors in front of the headings of one parent tag.
 
-def move_anchor_id_to_header(soup):
-    for tag in soup.find_all(re.compile(r'^h\d$')):
-        walk = tag
-        while True:
-            walk = walk.previous_sibling
-            if walk.name == 'a':
-                anchor = walk
-                break
-            elif walk.name == 'p' and walk.a is not None:
-                anchor = list(walk.find_all('a'))[-1]
-                break
-            elif walk is None or (walk.string or '').strip():
-                anchor = None
-                break
-        if not anchor:
-            print('Could not find anchor for', tag)
-            continue
-        id_ = anchor.get('id')
-        if id_ and (id_.startswith('a_chap') or id_.startswith('a_sec')):
-            tag['id'] = id_
+    Walking back over the previous siblings of every heading takes
+    quadratic time on pages with many headings. Instead the children of the
+    parent are scanned forward once, keeping the stops of a walk back in a
+    stack: the siblings which end it, with the anchor found there (None for
+    text). The anchor of a heading is then the one of the last stop.
+    '''
+    def __init__(self, parent):
+        self.next = parent.contents[0] if parent.contents else None
+        self.stops = []
+
+    def push(self, node):
+        if node.name == 'a':
+            self.stops.append((node, node))
+        elif node.name == 'p' and node.a is not None:
+            self.stops.append((node, node.find_all('a')[-1]))
+        elif (string(node) or '').strip():
+            self.stops.append((node, None))
+
+    def anchor(self, heading):
+        '''the anchor in front of heading, the headings are passed in document order'''
+        while self.next is not heading:
+            self.push(self.next)
+            self.next = self.next.next_sibling
+        return self.stops[-1][1] if self.stops else None
+
+    def unwrap(self, anchor):
+        '''unwrap the anchor returned last and scan what is left in its place'''
+        node, _ = self.stops.pop()
+        if node is anchor:
+            children = list(anchor.contents)
             anchor.unwrap()
+            for child in children:
+                self.push(child)
         else:
-            print('Found anchor but no id', anchor, tag)
-
-def remove_navigation(soup):
-    for tag in soup.find_all('div', **{'class': 'navigation'}):
+            anchor.unwrap()
+            self.push(node)
+
+@CLEANUP.rule(HEADER, after=['anchor_name_to_id_and_deduplicate', 'move_anchors_from_ul_to_li',
+                             'clean_headers', 'remove_comments', 'replace_inline_formula_images'])
+def move_anchor_id_to_header(tag, context):
+    scans = context.store.setdefault('anchor scans', {})
+    if id(tag.parent) not in scans:
+        scans[id(tag.parent)] = AnchorScan(tag.parent)
+    scan = scans[id(tag.parent)]
+    anchor = scan.anchor(tag)
+    if anchor is None:
+        print('Could not find anchor for', tag)
+        return
+    id_ = anchor.get('id')
+    if id_ and (id_.startswith('a_chap') or id_.startswith('a_sec')):
+        tag['id'] = id_
+        scan.unwrap(anchor)
+    else:
+        print('Found anchor but no id', anchor, tag)
+
+@CLEANUP.rule('a', attrs={'href': True}, after=['remove_toc_backlinks'])
+def update_anchors_href(tag, context):
+    href = tag['href']
+    i = href.find('#')
+    if i == -1:
+        i = len(href)
+    href_new = href[:i].replace('.html', '.xhtml') + href[i:].replace('%', 'a')
+    if href_new != href:
+        #print(href, '->', href_new)
+        tag['href'] = href_new
+
+@CLEANUP.rule('p', after=['move_anchor_id_to_header', 'move_table_out_of_p_tag',
+                          'replace_inline_formula_images', 'remove_comments'])
+def remove_empty_p_tag(tag, context):
+    is_empty = True
+    for x in tag.contents:
+        if x.name:
+            is_empty = False
+            break
+        elif x.strip():
+            is_empty = False
+            break
+    if is_empty:
         tag.decompose()
 
-def replace_quotes_and_dashes(soup):
-    for tag in soup.find_all(string=re.compile(r"''|``|--")):
-        if any(t.name == 'code' for t in tag.parents):
-            continue
-        tag.replace_with(
-            tag.replace("''", '\u201d')
-               .replace("``", '\u201c')
-               .replace("---", '\u2014')
-               .replace("--", '\u2013')
-        )
-
-def remove_comments(soup):
-    for tag in soup.findAll(text=lambda text:isinstance(text, Comment)):
-        tag.extract()
-
-def main():
-    doc = Document('book/book.html')
-    doc.make_xml()
-    doc.replace_resources()
-    doc.media['book/book.html'].attributes['properties'] = 'svg'
-    doc.remove_unused_images()
-    doc.set_cover('book/cover.jpg')
-
-    note = doc.media['book/book-Z-H-2.html'].soup.new_tag('p')
+@CLEANUP.rule(TOC_HEADER, after=['move_anchor_id_to_header', 'remove_empty_p_tag'])
+def collect_toc_entries(tag, context):
+    '''collect the (id, text, level) of the h1-h3 headings in context.store['toc']'''
+    entry = (tag.get('id'), ' '.join(tag.stripped_strings), int(tag.name[1:]))
+    context.store.setdefault('toc', []).append(entry)
+
+def minify_page(med):
+    '''page hook removing the whitespace and attributes which do not change the rendering, see minify.page'''
+    med.parsed(minify.page(med.soup, med.name))
+
+def add_license_note(med):
+    '''page hook adding the license of the epub at the top of the notes page'''
+    if med.name != 'book/book-Z-H-2.xhtml':
+        return
+    note = med.soup.new_tag('p')
     note.string = '''
 This book in epub format is licensed under a Creative Commons Attribution-ShareAlike 4.0 International License.
 It is a derivative work of Structure and Interpretation of Computer Programs by Harold Abelson and Gerald Jay Sussman with Julie Sussman which is licensed under a Creative Commons Attribution-ShareAlike 4.0 International License by the MIT Press.
 Modifications have been made not to the content but to the presentation in order to produce the epub file format.
 This book in epub format has no endorsement by the authors or MIT press.
 The following notes are copied from the MIT Press release of the book.'''
-    doc.media['book/book-Z-H-2.html'].soup.html.body.insert(0, note)
+    med.soup.html.body.insert(0, note)
+    med.modified()
+
+def build(output, parser='html5lib', jobs=1, cache=None, low_memory=False,
+          profiler=None, compare_parsers=False, children=None, frozen=None, **options):
+    '''
+    build the epub output from the book downloaded to the current directory:
+    transform the pages (see Document.make_xml) and package them (see
+    package(), which takes the other options).
+
+    children and frozen are passed to Document, see watch_build.
+    '''
+    if profiler is None:
+        profiler = Profiler()
+    doc = Document('book/book.html', parser=parser, profiler=profiler, children=children,
+                   frozen=frozen)
+    if compare_parsers:
+        doc.compare_parsers(jobs=jobs)
+    with tempfile.TemporaryDirectory() as spill:
+        with profiler.stage('make_xml'):
+            doc.make_xml(jobs=jobs, cache=cache, spill=spill if low_memory else None)
+        package(doc, output, jobs=jobs, cache=cache, spill=spill, **options)
+    return doc
+
+def package(doc, output, jobs=1, cache=None, spill=None, level=6, optimize_images=False,
+            allow_dangling_links=False, check=True, formats=('epub3',), timestamp=None,
+            split_size=SPLIT_SIZE, minify=False, freeze=False):
+    '''
+    add the files of new_content to the transformed pages of doc and
+    write the epub output.
+
+    formats are the names of targets.TARGETS to write, all from the same
+    transformed pages. the files of the other targets are named after
+    output, see targets.output_path.
+
+    raises links.DanglingLinks before anything is written if a link of a
+    page points to a missing file or id, unless allow_dangling_links is set.
+
+    with check=True the written epub files are checked with validate.validate
+    and validate.InvalidEpub is raised if they have problems.
+
+    pages larger than about split_size bytes are split into several files at
+    their sections (see Document.split_pages), 0 keeps all pages whole.
 
-    doc.set_height_on_images()
-    doc.update_links()
-    doc.write('sicp.epub')
+    with minify=True the pages and stylesheets are minified, see minify.py.
+    minify.TextChanged is raised if this would change the text of a page.
+
+    if timestamp (seconds since the epoch) is given, the build is
+    reproducible: the same sources give byte for byte the same files, see
+    Document.reproducible.
+
+    with freeze=True the pages are kept serialized (Document.freeze_pages),
+    doc can then be packaged again after the files of new_content changed.
+    '''
+    profiler = doc.profiler
+    with profiler.stage('replace_resources'):
+        doc.replace_resources()
+    if timestamp is not None:
+        with profiler.stage('source digest'):
+            doc.reproducible(timestamp)
+    if split_size:
+        with profiler.stage('split pages'):
+            doc.split_pages(split_size, spill=spill)
+    doc.media['book/book.html'].attributes['properties'] = 'svg'
+    doc.remove_unused_images()
+    doc.set_cover('book/cover.jpg')
+    with profiler.stage('validate links'):
+        dangling = doc.links.validate(doc.media)
+    for item in dangling:
+        print(f'{item.reason}: {item.page} {item.tag or ""} {item.url}')
+    if dangling and not allow_dangling_links:
+        raise DanglingLinks(dangling)
+    with profiler.stage('index_images'):
+        doc.index_images(None if cache is None or cache.directory is None
+                         else os.path.join(cache.directory, 'image-index.json'))
+    if optimize_images:
+        with profiler.stage('optimize_images'):
+            doc.optimize_images(jobs=jobs, cache=cache)
+
+    doc.page_hooks = [add_license_note, doc.set_height_on_images, doc.update_links]
+    if minify:
+        with profiler.stage('minify stylesheets'):
+            doc.minify_stylesheets()
+        # the last hook, after all changes to the page
+        doc.page_hooks.append(minify_page)
+    if freeze:
+        doc.freeze_pages()
+    with profiler.stage('write'):
+        paths = targets.write(doc, output, formats, level=level, jobs=jobs)
+
+    if check:
+        problems = []
+        for name, path in paths.items():
+            if not targets.TARGETS[name].epub:
+                continue
+            with profiler.stage('validate'):
+                found = validate.validate(path, jobs=jobs)
+            if len(paths) > 1:
+                found = [f'{path}: {problem}' for problem in found]
+            for problem in found:
+                print(problem)
+            problems += found
+        if problems:
+            raise validate.InvalidEpub(problems)
+
+def frozen_pages(doc):
+    '''
+    the serialized pages of doc by the cache key of their source, for
+    Document(frozen=...). replaced and split pages are left out.
+    '''
+    frozen = {}
+    for name, key in doc.source_keys.items():
+        med = doc.media.get(name)
+        if med is not None and med.path == name and med.name not in doc.split:
+            frozen[key] = med.get_data()
+    return frozen
+
+def watch_build(output, cache=None, parser='html5lib', low_memory=False, **options):
+    '''
+    build the book and build it again whenever a file in book/ or
+    new_content/ changes, until interrupted. the process stays resident
+    with the transformed pages (see cache.MemoryCache), the links found in
+    the sources and the serialized pages of the last build, and runs only
+    the stages a change needs:
+
+        pages in book/                  the changed pages are transformed
+                                        again, the others keep their
+                                        serialization (unless pages are
+                                        split, their links depend on
+                                        each other then)
+        other files in book/,           the pages are built again from
+        new_content/replace.ini         the transformed pages in memory
+        other files in new_content/     the pages of the last build are
+                                        packaged again, see package()
+        the code of the build           the process restarts itself
+
+    the images are not resident, every build reads them from their files
+    again (their dimensions are kept in the sidecar of the cache).
+
+    with low_memory nothing but the links found in the sources is kept
+    between builds: every change builds the book again, from the build
+    cache on disk.
+
+    options are those of package().
+    '''
+    code = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py')))
+    take = partial(watch.snapshot, watch.WATCHED, code)
+    resident = not low_memory
+    memory = MemoryCache(cache) if resident else cache
+    children = {}
+    doc = None
+    changed = []
+    state = take()
+    while True:
+        start = time.perf_counter()
+        resources_only = resident and doc is not None and changed and all(
+            path.startswith('new_content' + os.sep) and not path.endswith('.ini') for path in changed)
+        pages_only = resident and doc is not None and changed and not doc.split and all(
+            path.startswith('book' + os.sep) and path.endswith('.html') for path in changed)
+        try:
+            if resources_only:
+                doc.profiler = Profiler()
+                package(doc, output, cache=memory, freeze=True, **options)
+            else:
+                frozen = frozen_pages(doc) if pages_only else None
+                doc = None
+                doc = build(output, parser=parser, cache=memory, low_memory=low_memory,
+                            children=children, frozen=frozen, freeze=resident, **options)
+                if frozen and doc.split:
+                    print('pages were split, building all pages again')
+                    doc = None
+                    doc = build(output, parser=parser, cache=memory, low_memory=low_memory,
+                                children=children, freeze=True, **options)
+                if not resident:
+                    # its spilled pages were removed with the build
+                    doc = None
+            print(f'built {output} in {time.perf_counter() - start:.2f} s')
+        except (DanglingLinks, validate.InvalidEpub, minify.TextChanged) as error:
+            print(f'build failed: {error}')
+            # the next build starts from the sources again
+            doc = None
+        except Exception:
+            traceback.print_exc()
+            doc = None
+        print('waiting for changes in', ', '.join(watch.WATCHED))
+        state, changed = watch.wait_for_changes(take, state)
+        print('changed:', ', '.join(changed))
+        if set(changed) & set(code):
+            print('the code of the build changed, restarting')
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+def main():
+    parser = argparse.ArgumentParser(description='Produce the epub from the downloaded book.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of worker processes transforming pages (default: %(default)s)')
+    parser.add_argument('--cache', default='.build-cache',
+        help='directory of the build cache (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=256,
+        help='maximum size of the build cache in MB (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+        help='transform all pages without using the build cache')
+    parser.add_argument('--parser', choices=['html5lib', 'lxml'], default='html5lib',
+        help='parser backend for the html pages (default: %(default)s)')
+    parser.add_argument('--compare-parsers', action='store_true',
+        help='report the pages where the output of the html5lib and lxml backends differs')
+    parser.add_argument('--low-memory', action='store_true',
+        help='keep only the page being processed in memory, the others in a temporary directory')
+    parser.add_argument('--profile', metavar='FILE',
+        help='write the timings of the build steps as json to FILE and print them as a table')
+    parser.add_argument('--profile-memory', action='store_true',
+        help='also trace the peak memory of every step (slow)')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=6, metavar='0-9',
+        help='zlib level for the text members of the epub, 0 stores them (default: %(default)s)')
+    parser.add_argument('--optimize-images', action='store_true',
+        help='convert the GIF images to smaller PNG images without loss')
+    parser.add_argument('--allow-dangling-links', action='store_true',
+        help='only report links to missing files or ids instead of failing')
+    parser.add_argument('--no-validate', action='store_true',
+        help='do not check the structure of the written epub')
+    parser.add_argument('--split-size', type=int, default=SPLIT_SIZE // 1024, metavar='KB',
+        help='split pages larger than KB kilobytes at their sections, 0 never splits (default: %(default)s)')
+    parser.add_argument('--minify', action='store_true',
+        help='remove insignificant whitespace and default attributes from the pages and minify the stylesheets')
+    parser.add_argument('--reproducible', action='store_true',
+        default='SOURCE_DATE_EPOCH' in os.environ,
+        help='derive the book uuid from the sources and date the book to SOURCE_DATE_EPOCH '
+             '(1980-01-01 if unset), so the same sources give the same files '
+             '(default: on if SOURCE_DATE_EPOCH is set)')
+    parser.add_argument('--watch', action='store_true',
+        help='stay resident and build again when a file in book/ or new_content/ changes')
+    parser.add_argument('--format', nargs='+', choices=list(targets.TARGETS), default=['epub3'],
+        help='output formats, written from the same transformed pages (default: epub3)')
+    args = parser.parse_args()
+
+    cache = None
+    if not args.no_cache:
+        cache = BuildCache(args.cache, max_size=args.cache_size * 1024 * 1024)
+
+    timestamp = None
+    if args.reproducible:
+        timestamp = int(os.environ.get('SOURCE_DATE_EPOCH', ZIP_EPOCH))
+
+    options = dict(jobs=args.jobs, level=args.compress_level,
+                   optimize_images=args.optimize_images,
+                   allow_dangling_links=args.allow_dangling_links,
+                   check=not args.no_validate, formats=args.format, timestamp=timestamp,
+                   split_size=args.split_size * 1024, minify=args.minify)
+    if args.watch:
+        try:
+            watch_build('sicp.epub', cache=cache, parser=args.parser,
+                        low_memory=args.low_memory, **options)
+        except KeyboardInterrupt:
+            return
+
+    profiler = Profiler(memory=args.profile_memory)
+    try:
+        build('sicp.epub', parser=args.parser, cache=cache, low_memory=args.low_memory,
+              profiler=profiler, compare_parsers=args.compare_parsers, **options)
+    except DanglingLinks as error:
+        sys.exit(f'{error} (see above), use --allow-dangling-links to build anyway')
+    except validate.InvalidEpub as error:
+        sys.exit(f'{error} (see above)')
+    except minify.TextChanged as error:
+        sys.exit(f'{error}, build without --minify')
+
+    if args.profile:
+        profiler.dump(args.profile)
+        print(profiler.table())
 
 if __name__ == '__main__':
     main()
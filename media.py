@@ -1,18 +1,123 @@
+import pickle
+import re
 from dataclasses import dataclass, field
-from itertools import count
+import tree
 
-_ids = (f'item{n}' for n in count(1000))
+def medium_id(name):
+    '''the manifest id of the medium name, the same in every build'''
+    return 'item-' + re.sub(r'[^A-Za-z0-9._-]', '_', name)
 
 @dataclass
 class Medium:
+    '''
+    A file of the book, which goes through the states
+
+        raw: data holds the content of the file, or it is read from path
+            when it is needed (see load())
+        parsed: soup holds the parsed page (see parsed())
+        spilled: the parsed page was moved out of memory into a file (see
+            spill()) and is parsed again by restore()
+        frozen: the page was serialized (by get_data() or freeze()) and the
+            serialization is reused until the soup is modified again
+
+    Generated files (like the toc) have a stream instead, a function
+    returning the content as an iterable of str, which is written to the
+    epub chunk by chunk.
+
+    BeautifulSoup does not tell when a tree changes, so code modifying
+    the soup of a medium calls modified() to drop the serialization.
+    '''
     name: str
     data: str
-    id: str = field(default_factory=lambda:next(_ids))
+    id: str = None
     attributes: dict = field(default_factory=dict)
     soup: object = None
+    toc: list = None
+    frozen: bytes = field(default=None, repr=False)
+    path: str = None
+    text: bool = False
+    spilled: str = None
+    stream: object = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if self.id is None:
+            self.id = medium_id(self.name)
+
+    @property
+    def state(self):
+        if self.soup is None:
+            return 'raw' if self.spilled is None else 'spilled'
+        return 'parsed' if self.frozen is None else 'frozen'
+
+    def load(self):
+        '''the raw content, read from self.path (in text mode if self.text) if data is None'''
+        if self.data is None and self.path is not None:
+            with open(self.path, 'r' if self.text else 'rb') as f:
+                return f.read()
+        return self.data
+
+    def parsed(self, soup):
+        '''replace the content by the parsed page soup'''
+        self.soup = soup
+        self.data = None
+        self.frozen = None
+
+    def modified(self):
+        '''to be called after changing the soup'''
+        self.frozen = None
+
+    def freeze(self):
+        '''serialize the soup once, returning the utf-8 encoded page'''
+        if self.frozen is None:
+            self.frozen = tree.markup(self.soup).encode('utf-8')
+        return self.frozen
+
+    def drop_tree(self):
+        '''keep only the serialization of the page, which is raw again with data holding it'''
+        data = self.freeze()
+        self.release()
+        self.spilled = None
+        self.data = data
+
+    def chunks(self):
+        '''
+        the content as an iterable of chunks. a page which is not frozen
+        is serialized chunk by chunk (see tree.serialize) instead of
+        building the whole page in memory.
+        '''
+        if self.stream is not None:
+            return self.stream()
+        if self.soup is not None and self.frozen is None:
+            return tree.serialize(self.soup)
+        return [self.get_data()]
+
+    def spill(self, path, events=None):
+        '''
+        move the parsed page to the file path, stored as the events of
+        tree.flatten (which can be given if they are known already)
+        '''
+        if events is None:
+            events = tree.flatten(self.soup)
+        with open(path, 'wb') as f:
+            pickle.dump(events, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spilled = path
+        self.data = None
+        self.release()
+
+    def restore(self):
+        '''parse the spilled page again'''
+        with open(self.spilled, 'rb') as f:
+            self.parsed(tree.unflatten(pickle.load(f)))
+
+    def release(self):
+        '''drop the tree and serialization of the page from memory'''
+        self.soup = None
+        self.frozen = None
 
     def get_data(self):
+        if self.stream is not None:
+            return ''.join(self.stream())
         if self.soup is not None:
-            return str(self.soup)
+            return self.freeze()
         else:
-            return self.data
+            return self.load()
@@ -0,0 +1,150 @@
+'''
+Smaller pages and stylesheets for the epub.
+
+page() removes what does not change the rendering of a page: runs of
+whitespace are collapsed to one space, whitespace next to the start or end
+of a block element is removed (a reader drops it at the start and end of
+a line) and attributes which only repeat the default are dropped. The
+text in pre, code, script, style and textarea elements is kept as it is.
+
+The page is rewritten as the events of tree.flatten in one pass and built
+again with tree.unflatten. The text of the page as a reader renders it
+(see text_tokens) is compared before and after, TextChanged is raised if
+it differs.
+
+css() removes the comments and the whitespace of a stylesheet.
+'''
+
+import re
+from bs4 import NavigableString
+import tree
+
+# elements which keep their whitespace
+PRESERVE = {'pre', 'code', 'script', 'style', 'textarea'}
+# elements which start and end a line when they are rendered, or are not
+# rendered at all
+BLOCKS = {
+    'html', 'head', 'title', 'meta', 'link', 'style', 'script', 'body',
+    'address', 'blockquote', 'center', 'div', 'figure', 'figcaption', 'form',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'nav', 'p', 'pre', 'section',
+    'dl', 'dt', 'dd', 'ol', 'ul', 'li',
+    'table', 'caption', 'colgroup', 'col', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th',
+}
+# attributes with their default value, by element. the type of style and
+# script elements is required in epub 2.
+DEFAULTS = {
+    'link': {'type': 'text/css'},
+    'a': {'shape': 'rect'},
+    'td': {'colspan': '1', 'rowspan': '1'},
+    'th': {'colspan': '1', 'rowspan': '1'},
+}
+# whitespace in html, \s would also match the no-break space
+WHITESPACE = re.compile(r'[ \t\n\r\f]+')
+
+class TextChanged(Exception):
+    def __init__(self, name):
+        super().__init__(f'minifying {name} changed its text')
+        self.name = name
+
+def attributes(name, attrs):
+    '''attrs without the empty class and style and the defaults of element name'''
+    defaults = DEFAULTS.get(name, {})
+    return {key: value for key, value in attrs.items()
+            if defaults.get(key) != value and not (key in ('class', 'style') and not value)}
+
+def starts_block(event):
+    return event not in (None, tree.END) and event[0] == tree.TAG and event[1] in BLOCKS
+
+def minify_events(events):
+    '''the events of tree.flatten for the minified page'''
+    result = []
+    # the open elements, the number of them keeping their whitespace and
+    # the last element which ended
+    stack = []
+    preserved = 0
+    closed = None
+    for i, event in enumerate(events):
+        if event is tree.END:
+            closed = stack.pop()
+            preserved -= closed in PRESERVE
+            result.append(event)
+        elif event[0] == tree.TAG:
+            _, name, prefix, namespace, attrs = event
+            stack.append(name)
+            preserved += name in PRESERVE
+            result.append((tree.TAG, name, prefix, namespace, attributes(name, attrs)))
+        else:
+            _, cls, text = event
+            if cls is not NavigableString or preserved:
+                result.append(event)
+                continue
+            text = WHITESPACE.sub(' ', text)
+            # the string follows the start of its parent or the end of its
+            # previous sibling and is followed by the start of its next
+            # sibling or the end of its parent
+            previous = events[i - 1] if i else None
+            following = events[i + 1] if i + 1 < len(events) else tree.END
+            if starts_block(previous) or previous is tree.END and closed in BLOCKS:
+                text = text.lstrip(' ')
+            if starts_block(following) or following is tree.END and (not stack or stack[-1] in BLOCKS):
+                text = text.rstrip(' ')
+            if text:
+                result.append((tree.STRING, cls, text))
+    return result
+
+def text_tokens(events):
+    '''
+    the text of the page as a reader renders it: the words, with the
+    preserved texts as ('pre', text) tuples. blocks separate words.
+    '''
+    tokens = []
+    words = []
+    stack = []
+    preserved = 0
+    for event in events:
+        if event is tree.END:
+            name = stack.pop()
+            preserved -= name in PRESERVE
+            if name in BLOCKS:
+                words.append(' ')
+        elif event[0] == tree.TAG:
+            stack.append(event[1])
+            preserved += event[1] in PRESERVE
+            if event[1] in BLOCKS:
+                words.append(' ')
+        elif event[1] is NavigableString:
+            if preserved:
+                tokens += WHITESPACE.split(''.join(words))
+                words.clear()
+                tokens.append(('pre', event[2]))
+            else:
+                words.append(event[2])
+    tokens += WHITESPACE.split(''.join(words))
+    return [token for token in tokens if token]
+
+def page(soup, name=None):
+    '''the minified copy of the page soup, raises TextChanged if its text would change'''
+    events = tree.flatten(soup)
+    minified = minify_events(events)
+    if text_tokens(minified) != text_tokens(events):
+        raise TextChanged(name)
+    return tree.unflatten(minified)
+
+# the strings and comments of a stylesheet
+CSS_STRING = r'"(?:[^"\\]|\\.)*"' + r"|'(?:[^'\\]|\\.)*'"
+CSS_COMMENTS = re.compile(rf'({CSS_STRING})|/\*.*?\*/', re.S)
+CSS_STRINGS = re.compile(f'({CSS_STRING})')
+CSS_SPACE = re.compile(r' ?([{};,>]) ?')
+
+def css(text):
+    '''the stylesheet text without comments and insignificant whitespace'''
+    text = CSS_COMMENTS.sub(lambda match: match.group(1) or ' ', text)
+    # the code and the strings alternate, the strings are kept as they are
+    parts = CSS_STRINGS.split(text)
+    parts[::2] = [css_code(code) for code in parts[::2]]
+    return ''.join(parts).strip()
+
+def css_code(code):
+    '''the css code between strings and comments without insignificant whitespace'''
+    code = CSS_SPACE.sub(r'\1', WHITESPACE.sub(' ', code))
+    return code.replace(': ', ':').replace(';}', '}')
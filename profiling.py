@@ -0,0 +1,108 @@
+'''
+Timing of the steps of the build.
+
+A Profiler collects the wall time, the number of calls and the number of
+nodes visited for named steps, e.g. a stage of Document or a rule of the
+cleanup. Steps may be nested, the time of a step includes the time of the
+steps inside it.
+
+With memory=True the allocations are traced with tracemalloc (which slows
+down the build considerably) and the peak of the traced memory is recorded
+for every step. The high-water mark of the process size (max_rss) at the
+end of a step is always recorded, where the resource module is available
+(not on windows, max_rss is None there).
+
+Steps which ran in worker processes are added with merge().
+'''
+
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def max_rss():
+    '''the high-water mark of the process size in bytes, None if it is not available'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macos gives bytes, linux and the bsds kilobytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class Profiler:
+    def __init__(self, memory=False):
+        self.stats = {}
+        self.memory = memory
+        self.started = time.perf_counter()
+        # peaks of the steps currently running, see stage()
+        self._peaks = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def add(self, name, seconds, calls=1, nodes=0, peak_memory=None):
+        stat = self.stats.setdefault(name,
+            {'calls': 0, 'seconds': 0.0, 'nodes': 0, 'peak_memory': None, 'max_rss': None})
+        stat['calls'] += calls
+        stat['seconds'] += seconds
+        stat['nodes'] += nodes
+        if peak_memory is not None:
+            stat['peak_memory'] = max(stat['peak_memory'] or 0, peak_memory)
+        return stat
+
+    @contextmanager
+    def stage(self, name, nodes=0):
+        '''
+        time the with block as one call of name. the nodes visited are
+        counted in the yielded dict: counter['nodes'] += n
+        '''
+        counter = {'nodes': nodes}
+        if self.memory:
+            # tracemalloc has only one peak, so the peak of the enclosing
+            # step is carried over before it is reset for this step
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield counter
+        finally:
+            seconds = time.perf_counter() - start
+            peak = None
+            if self.memory:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+            stat = self.add(name, seconds, nodes=counter['nodes'], peak_memory=peak)
+            stat['max_rss'] = max_rss()
+
+    def merge(self, stats):
+        '''add the stats of another profiler, e.g. from a worker process'''
+        for name, stat in stats.items():
+            self.add(name, stat['seconds'], stat['calls'], stat['nodes'], stat['peak_memory'])
+
+    def report(self):
+        return {
+            'total_seconds': time.perf_counter() - self.started,
+            'memory_traced': self.memory,
+            'stages': self.stats,
+        }
+
+    def dump(self, path):
+        '''write the report as json'''
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def table(self):
+        '''the stats as a text table, the slowest steps first'''
+        def mb(value):
+            return '' if value is None else f'{value / 2**20:.1f}'
+        lines = [f'{"step":<40} {"calls":>7} {"seconds":>9} {"nodes":>10} {"peak MB":>8} {"rss MB":>8}']
+        for name, stat in sorted(self.stats.items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f'{name:<40} {stat["calls"]:>7} {stat["seconds"]:>9.3f} {stat["nodes"]:>10}'
+                         f' {mb(stat["peak_memory"]):>8} {mb(stat["max_rss"]):>8}')
+        return '\n'.join(lines)
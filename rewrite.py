@@ -0,0 +1,175 @@
+'''
+A rule based rewrite engine for parsed pages.
+
+Cleanup passes register themselves as rules of a RuleSet, naming the
+tags (or strings) they handle and the rules which have to run before
+them. Instead of every pass searching the whole tree with find_all,
+the engine collects the candidates of all rules in one traversal and
+then runs the rules one after the other, in dependency order, on their
+candidates.
+
+A candidate list is taken when the traversal happens, so a rule which
+has to see nodes created or moved by the rules before it (e.g. because
+it depends on the document order of elements) is marked `fresh`: the
+engine starts a new traversal for it, shared by all following rules up
+to the next fresh rule.
+
+Candidates which an earlier rule removed from the tree are skipped.
+
+If a profiling.Profiler is given, apply() records the time of every
+traversal and rule, and the number of nodes they visited.
+'''
+
+import re
+import time
+from collections import namedtuple
+from bs4 import Tag
+
+Rule = namedtuple('Rule', 'name, handler, names, string, attrs, after, fresh')
+
+class Context:
+    '''
+    Passed to every handler together with the node.
+
+        self.soup: the tree being rewritten
+        self.store: a dict for state which rules keep while rewriting a page
+        self.visited: number of nodes visited by the traversals
+    '''
+    def __init__(self, soup):
+        self.soup = soup
+        self.store = {}
+        self.visited = 0
+
+class RuleSet:
+    def __init__(self):
+        self.rules = []
+        self._stages = None
+
+    def rule(self, *names, string=None, attrs=None, after=(), fresh=False):
+        '''
+        decorator registering a handler(node, context) as a rule.
+
+            names: tag names (or compiled regular expressions matching tag names)
+            string: instead of tags, handle strings which are instances of the
+                given class, match the given regular expression, or all strings if True
+            attrs: dict of attribute conditions like the ones of find_all: True
+                (attribute present), a string or a regular expression
+            after: names of rules which have to run before this one
+            fresh: collect the candidates in a new traversal
+        '''
+        def register(handler):
+            self.rules.append(Rule(handler.__name__, handler, names, string,
+                                   attrs or {}, tuple(after), fresh))
+            self._stages = None
+            return handler
+        return register
+
+    def ordered(self):
+        '''the rules in dependency order, otherwise in the order of registration'''
+        by_name = {rule.name: rule for rule in self.rules}
+        for rule in self.rules:
+            for name in rule.after:
+                if name not in by_name:
+                    raise ValueError(f'rule {rule.name} depends on unknown rule {name}')
+        done = set()
+        result = []
+        while len(result) < len(self.rules):
+            for rule in self.rules:
+                if rule.name not in done and all(name in done for name in rule.after):
+                    break
+            else:
+                raise ValueError('rules have cyclic dependencies')
+            done.add(rule.name)
+            result.append(rule)
+        return result
+
+    def stages(self):
+        '''the ordered rules, split into groups sharing one traversal'''
+        if self._stages is None:
+            self._stages = []
+            for rule in self.ordered():
+                if rule.fresh or not self._stages:
+                    self._stages.append([])
+                self._stages[-1].append(rule)
+        return self._stages
+
+    def apply(self, soup, profiler=None):
+        '''rewrite the tree in place, returning the Context'''
+        context = Context(soup)
+        for stage in self.stages():
+            start = time.perf_counter()
+            visited = context.visited
+            candidates = collect(soup, stage, context)
+            if profiler is not None:
+                profiler.add('rewrite: traversal', time.perf_counter() - start,
+                              nodes=context.visited - visited)
+            for rule in stage:
+                start = time.perf_counter()
+                handled = 0
+                for node in candidates[rule.name]:
+                    if attached(node, soup):
+                        rule.handler(node, context)
+                        handled += 1
+                if profiler is not None:
+                    profiler.add('rule: ' + rule.name, time.perf_counter() - start, nodes=handled)
+        return context
+
+def collect(soup, rules, context):
+    '''traverse the tree once and return the candidates of every rule'''
+    candidates = {rule.name: [] for rule in rules}
+    tag_rules = {}
+    string_rules = [rule for rule in rules if rule.string is not None]
+    for node in soup.descendants:
+        context.visited += 1
+        if isinstance(node, Tag):
+            if node.name not in tag_rules:
+                tag_rules[node.name] = [rule for rule in rules
+                    if rule.string is None and name_matches(node.name, rule.names)]
+            for rule in tag_rules[node.name]:
+                if all(attr_matches(node.get(key), value) for key, value in rule.attrs.items()):
+                    candidates[rule.name].append(node)
+        else:
+            for rule in string_rules:
+                if string_matches(node, rule.string):
+                    candidates[rule.name].append(node)
+    return candidates
+
+def name_matches(name, names):
+    if not names:
+        return True
+    for expected in names:
+        if isinstance(expected, re.Pattern):
+            if expected.search(name):
+                return True
+        elif expected == name:
+            return True
+    return False
+
+def attr_matches(value, expected):
+    if expected is True:
+        return value is not None
+    if value is None:
+        return False
+    if isinstance(value, list):
+        return any(attr_matches(item, expected) for item in value) or \
+            attr_matches(' '.join(value), expected)
+    if isinstance(expected, re.Pattern):
+        return expected.search(value) is not None
+    return value == expected
+
+def string_matches(node, expected):
+    if expected is True:
+        return True
+    if isinstance(expected, type):
+        return isinstance(node, expected)
+    return expected.search(node) is not None
+
+def attached(node, root):
+    '''true if the node was not removed from the tree below root'''
+    # not node.decomposed: for tags, looking up the missing attribute
+    # falls back to searching the subtree for a tag of that name
+    if vars(node).get('_decomposed'):
+        return False
+    while node.parent is not None:
+        node = node.parent
+    return node is root
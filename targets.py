@@ -0,0 +1,214 @@
+'''
+The output formats of the book.
+
+make_epub.build() parses and transforms the pages, builds the toc and
+indexes the images once, then every target packages the same Document:
+
+    epub3   the epub 3 book, with the nav document and the ncx
+    epub2   an epub 2 book for older readers: no nav document and no
+            epub 3 metadata or properties
+    kepub   the epub 3 book for Kobo readers, with the text of the pages
+            wrapped in the koboSpan elements of the Kobo software
+    html    all pages in one html file, with the toc, the stylesheets and
+            the images (as data: urls) included
+
+With more than one target the page hooks are applied once and only the
+serialized pages are kept (Document.freeze_pages). The targets then run
+concurrently in threads, they only read the document. zlib and lxml
+release the GIL for most of their work.
+'''
+
+import base64
+import mimetypes
+import posixpath
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from xml.sax.saxutils import escape
+from lxml import etree
+from profiling import Profiler
+
+XHTML = '{http://www.w3.org/1999/xhtml}'
+SVG = '{http://www.w3.org/2000/svg}'
+MATHML = '{http://www.w3.org/1998/Math/MathML}'
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+# elements starting a new paragraph of the koboSpan ids
+KOBO_BLOCKS = {XHTML + name for name in (
+    'p', 'div', 'li', 'dt', 'dd', 'td', 'th', 'caption', 'blockquote', 'pre',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6')}
+# elements whose text is not wrapped in koboSpans
+KOBO_SKIP = (XHTML + 'script', XHTML + 'style', SVG + 'svg', MATHML + 'math')
+
+def kobo_spans(data):
+    '''
+    add the kepub markup to the xhtml page data: every text is wrapped in a
+    <span class="koboSpan" id="kobo.P.S"> (P counts the paragraphs, S the
+    texts in a paragraph) and the content of the body in the book-columns
+    and book-inner divs
+    '''
+    root = etree.fromstring(data)
+    body = root.find(XHTML + 'body')
+    if body is None:
+        return data
+    skipped = set()
+    for el in body.iter(*KOBO_SKIP):
+        skipped.update(el.iter())
+    paragraph = segment = 0
+
+    def span(text):
+        nonlocal segment
+        segment += 1
+        el = etree.Element(XHTML + 'span', {'class': 'koboSpan', 'id': f'kobo.{paragraph}.{segment}'})
+        el.text = text
+        return el
+
+    # the texts are wrapped in document order: the text of an element at
+    # its start, the tail at its end
+    for action, el in list(etree.iterwalk(body, events=('start', 'end'))):
+        if not isinstance(el.tag, str):
+            continue
+        if action == 'start':
+            if el.tag in KOBO_BLOCKS:
+                paragraph += 1
+                segment = 0
+            if el not in skipped and (el.text or '').strip():
+                el.insert(0, span(el.text))
+                el.text = None
+        elif el is not body and el.getparent() not in skipped and (el.tail or '').strip():
+            tail, el.tail = el.tail, None
+            el.addnext(span(tail))
+
+    columns = etree.SubElement(body, XHTML + 'div', {'id': 'book-columns'})
+    inner = etree.SubElement(columns, XHTML + 'div', {'id': 'book-inner'})
+    inner.text, body.text = body.text, None
+    for child in list(body)[:-1]:
+        inner.append(child)
+    return etree.tostring(root, encoding='utf-8')
+
+def section_id(name):
+    '''the id of the section of the page name in the single html file'''
+    return posixpath.splitext(name)[0].replace('/', '-')
+
+class SingleHtml:
+    '''writes all pages of a Document into one html file'''
+    def __init__(self, doc):
+        self.doc = doc
+        self.media = {med.name: med for med in doc.media.values()}
+        by_id = {med.id: med for med in doc.media.values()}
+        self.pages = [by_id[med.id] for med in doc.spine]
+        in_spine = {med.id for med in self.pages}
+        self.pages += [med for med in doc.media.values()
+                       if med.name.endswith(('.xhtml', '.html')) and med.id not in in_spine
+                       and med.stream is None]
+        self.sections = {med.name: section_id(med.name) for med in self.pages}
+        # data: urls of the images by name
+        self.images = {}
+
+    def link(self, page, url):
+        '''the url relative to page as a link into the single file'''
+        path, _, fragment = urljoin(page, url).partition('#')
+        if path not in self.sections:
+            return url
+        return '#' + self.sections[path] + ('.' + fragment if fragment else '')
+
+    def image(self, page, url):
+        '''the image url relative to page as a data: url'''
+        name = urljoin(page, url)
+        if name not in self.media:
+            return url
+        if name not in self.images:
+            data = self.media[name].get_data()
+            self.images[name] = (f'data:{mimetypes.guess_type(name)[0]};base64,'
+                                 + base64.b64encode(data).decode('ascii'))
+        return self.images[name]
+
+    def section(self, med):
+        '''the html of the body of the page as a section'''
+        root = etree.fromstring(med.get_data())
+        body = root.find(XHTML + 'body')
+        body.tag = XHTML + 'section'
+        prefix = self.sections[med.name] + '.'
+        for el in body.iter(etree.Element):
+            if el.get('id') is not None:
+                el.set('id', prefix + el.get('id'))
+            if el.tag == XHTML + 'a' and el.get('href') is not None:
+                el.set('href', self.link(med.name, el.get('href')))
+            elif el.tag == XHTML + 'img' and el.get('src') is not None:
+                el.set('src', self.image(med.name, el.get('src')))
+            elif el.tag == SVG + 'image' and el.get(XLINK_HREF) is not None:
+                el.set(XLINK_HREF, self.image(med.name, el.get(XLINK_HREF)))
+        body.set('id', self.sections[med.name])
+        return etree.tostring(body, method='html', encoding='unicode', with_tail=False)
+
+    def lines(self):
+        '''generate the html file'''
+        yield '<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n'
+        yield f'<title>{escape(self.doc.title)}</title>\n'
+        for med in self.doc.media.values():
+            if med.name.endswith('.css'):
+                css = med.get_data()
+                yield '<style>\n' + (css.decode('utf-8') if isinstance(css, bytes) else css) + '\n</style>\n'
+        yield '</head>\n<body>\n<nav id="toc">\n'
+        yield from self.doc.toc.list_lines(link=lambda href: self.link('', href))
+        yield '</nav>\n'
+        for med in self.pages:
+            yield self.section(med)
+            yield '\n'
+        yield '</body>\n</html>\n'
+
+def epub3(doc, path, level=6, jobs=1, profiler=None):
+    doc.write(path, level=level, jobs=jobs, profiler=profiler)
+
+def epub2(doc, path, level=6, jobs=1, profiler=None):
+    doc.write(path, level=level, jobs=jobs, version=2, profiler=profiler)
+
+def kepub(doc, path, level=6, jobs=1, profiler=None):
+    doc.write(path, level=level, jobs=jobs, rewrite_page=kobo_spans, profiler=profiler)
+
+def html(doc, path, level=6, jobs=1, profiler=None):
+    '''write the single html file, level and jobs are not used'''
+    # the pages are read as xhtml, after the page hooks
+    doc.freeze_pages()
+    if doc.toc is None:
+        doc.add_toc()
+    with (profiler or doc.profiler).stage('single html'), open(path, 'w', encoding='utf-8') as f:
+        for line in SingleHtml(doc).lines():
+            f.write(line)
+
+# the suffix replacing .epub in the name of the output, the function
+# writing the target and whether the output is an epub file
+Target = namedtuple('Target', 'suffix, write, epub')
+
+TARGETS = {
+    'epub3': Target('.epub', epub3, True),
+    'epub2': Target('.epub2.epub', epub2, True),
+    'kepub': Target('.kepub.epub', kepub, True),
+    'html': Target('.html', html, False),
+}
+
+def output_path(output, name):
+    '''the file of the target name for the epub file output'''
+    base = output[:-len('.epub')] if output.endswith('.epub') else output
+    return base + TARGETS[name].suffix
+
+def write(doc, output, names, level=6, jobs=1):
+    '''write the targets names of doc, returning their files by name'''
+    paths = {name: output_path(output, name) for name in names}
+    if len(paths) == 1:
+        [name] = paths
+        TARGETS[name].write(doc, paths[name], level=level, jobs=jobs)
+        return paths
+    doc.freeze_pages()
+    doc.add_toc()
+    # a Profiler is not thread safe, every target gets its own
+    profilers = {name: Profiler() for name in paths}
+    with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+        futures = [pool.submit(TARGETS[name].write, doc, path, level=level, jobs=jobs,
+                               profiler=profilers[name])
+                   for name, path in paths.items()]
+        for future in futures:
+            future.result()
+    for name, profiler in profilers.items():
+        doc.profiler.merge({f'{name}: {step}': stat for step, stat in profiler.stats.items()})
+    return paths
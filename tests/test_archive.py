@@ -0,0 +1,98 @@
+'''
+Write zip files with archive.ArchiveWriter, which appends the members
+compressed in its pool with zipfile internals, and read them back with
+zipfile: the members, their content and compression and their CRCs
+(ZipFile.testzip) must be right with and without the pool.
+
+usage: python -m unittest tests/test_archive.py (from the top directory)
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import archive
+
+def members():
+    '''(name, data, how) of the test members, how is 'add' or 'stream' '''
+    rng = random.Random(1)
+    text = ''.join(rng.choice('abc <p>\n') for _ in range(200000))
+    noise = bytes(rng.getrandbits(8) for _ in range(50000))
+    return [
+        ('mimetype', b'application/epub+zip', 'add'),
+        ('META-INF/container.xml', '<?xml version="1.0"?>\n<container/>', 'add'),
+        ('book/empty.xhtml', b'', 'add'),
+        ('book/text.xhtml', text, 'add'),
+        ('book/unicode.xhtml', 'λ → ∞ ' * 1000, 'add'),
+        # deflate does not pay off, it is stored
+        ('book/noise.xhtml', noise, 'add'),
+        ('book/image.png', noise[:20000], 'add'),
+        ('toc.ncx', [text[i:i + 1000] for i in range(0, len(text), 1000)], 'stream'),
+        ('toc.xhtml', ['<nav>', b'\xce\xbb', '</nav>'], 'stream'),
+        ('book/after.css', 'body { margin: 0 }\n' * 100, 'add'),
+    ]
+
+def content(data):
+    if isinstance(data, list):
+        data = b''.join(chunk.encode('utf-8') if isinstance(chunk, str) else chunk for chunk in data)
+    return data.encode('utf-8') if isinstance(data, str) else data
+
+class ArchiveWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, jobs, level=6, timestamp=None):
+        path = os.path.join(self.directory, f'test-{jobs}-{level}.zip')
+        with archive.ArchiveWriter(path, level=level, jobs=jobs, timestamp=timestamp) as writer:
+            for name, data, how in members():
+                if name == 'mimetype':
+                    writer.add(name, data, compress_type=zipfile.ZIP_STORED)
+                elif how == 'stream':
+                    writer.add_stream(name, iter(data))
+                else:
+                    writer.add(name, data)
+        return path
+
+    def check(self, path, level):
+        with zipfile.ZipFile(path) as result:
+            self.assertIsNone(result.testzip())
+            infos = result.infolist()
+            self.assertEqual([info.filename for info in infos], [name for name, _, _ in members()])
+            for info, (name, data, _) in zip(infos, members()):
+                self.assertEqual(result.read(info), content(data), name)
+                self.assertEqual(info.file_size, len(content(data)), name)
+                if level == 0 or name in ('mimetype', 'book/noise.xhtml', 'book/image.png'):
+                    self.assertEqual(info.compress_type, zipfile.ZIP_STORED, name)
+                elif info.file_size > 100:
+                    self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED, name)
+                    self.assertLess(info.compress_size, info.file_size, name)
+            self.assertEqual(infos[0].extra, b'')
+        return infos
+
+    def test_round_trip(self):
+        for jobs in (1, 2, 4):
+            for level in (0, 6, 9):
+                with self.subTest(jobs=jobs, level=level):
+                    self.check(self.write(jobs, level), level)
+
+    def test_reproducible(self):
+        '''with a timestamp all members have its date, the same with any number of jobs'''
+        timestamp = 1700000000
+        results = []
+        for jobs in (1, 3):
+            infos = self.check(self.write(jobs, timestamp=timestamp), 6)
+            self.assertEqual({info.date_time for info in infos}, {(2023, 11, 14, 22, 13, 20)})
+            results.append([(info.filename, info.CRC, info.compress_type) for info in infos])
+        self.assertEqual(results[0], results[1])
+        # dates before 1980 can not be stored
+        infos = self.check(self.write(2, timestamp=0), 6)
+        self.assertEqual({info.date_time for info in infos}, {(1980, 1, 1, 0, 0, 0)})
+
+if __name__ == '__main__':
+    unittest.main()
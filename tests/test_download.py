@@ -0,0 +1,167 @@
+'''
+Crawl a small book served by http.server on localhost and check the
+conditional requests of download.py --refresh: a second crawl only gets
+304 responses and rewrites nothing, after one file changed on the server
+only that file is downloaded again and its manifest entry is updated.
+
+usage: python -m unittest tests/test_download.py (from the top directory)
+'''
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import download
+
+PAGES = {
+    'book/book.html': b'<html><head><link rel="stylesheet" href="book.css"></head>'
+                      b'<body><img src="cover.gif"><a href="book-Z-H-1.html">next</a></body></html>',
+    'book/book-Z-H-1.html': b'<html><head><link rel="stylesheet" href="book.css"></head>'
+                            b'<body><img src="ch1-Z-G-1.gif"></body></html>',
+    'book/book.css': b'body { margin: 1em }',
+    'book/cover.gif': b'GIF89a cover',
+    'book/ch1-Z-G-1.gif': b'GIF89a figure',
+}
+
+class Handler(SimpleHTTPRequestHandler):
+    '''serves the files with an ETag (the sha256 of the content) and records the requests'''
+    def send_head(self):
+        self.etag = None
+        path = self.translate_path(self.path)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.etag = '"%s"' % hashlib.sha256(f.read()).hexdigest()
+            if self.headers.get('If-None-Match') == self.etag:
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.end_headers()
+                return None
+        return super().send_head()
+
+    def end_headers(self):
+        if self.etag:
+            self.send_header('ETag', self.etag)
+        super().end_headers()
+
+    def log_request(self, code='-', size='-'):
+        self.server.requests.append((self.path, int(code)))
+
+class ConditionalDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.site = os.path.join(self.directory, 'site')
+        for name, data in PAGES.items():
+            self.write(name, data)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(Handler, directory=self.site))
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/'
+        self.saved_base_url = download.BASE_URL
+        download.BASE_URL = self.base_url
+        self.cwd = os.getcwd()
+        os.makedirs(os.path.join(self.directory, 'local', 'book'))
+        os.chdir(os.path.join(self.directory, 'local'))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        download.BASE_URL = self.saved_base_url
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data, mtime=None):
+        path = os.path.join(self.site, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def crawl(self, refresh):
+        '''crawl the book with a manifest loaded from its file, return the results and the requests'''
+        self.server.requests = []
+        crawler = download.Crawler(rate=1000, burst=10, workers=2, refresh=refresh,
+                                   manifest=download.Manifest('manifest.json'))
+        crawler.crawl(self.base_url + 'book/book.html')
+        return crawler.results, sorted(self.server.requests)
+
+    def files(self):
+        '''the (content, mtime_ns, inode) of the downloaded files'''
+        result = {}
+        for name in PAGES:
+            stat = os.stat(name)
+            with open(name, 'rb') as f:
+                result[name] = f.read(), stat.st_mtime_ns, stat.st_ino
+        return result
+
+    def manifest(self):
+        return download.Manifest('manifest.json').entries
+
+    def test_refresh(self):
+        results, requests = self.crawl(refresh=False)
+        self.assertEqual(results, {'downloaded': len(PAGES)})
+        self.assertEqual(requests, sorted(('/' + name, 200) for name in PAGES))
+        files = self.files()
+        self.assertEqual({name: data for name, (data, _, _) in files.items()}, PAGES)
+        manifest = self.manifest()
+        self.assertEqual(sorted(manifest), sorted(self.base_url + name for name in PAGES))
+        for name, data in PAGES.items():
+            entry = manifest[self.base_url + name]
+            self.assertEqual(entry['name'], name)
+            self.assertEqual(entry['sha256'], hashlib.sha256(data).hexdigest())
+            self.assertEqual(entry['etag'], '"%s"' % entry['sha256'])
+            self.assertTrue(entry['last_modified'])
+
+        # nothing changed: every request is answered with 304, no file is rewritten
+        results, requests = self.crawl(refresh=True)
+        self.assertEqual(results, {'not modified': len(PAGES)})
+        self.assertEqual(requests, sorted(('/' + name, 304) for name in PAGES))
+        self.assertEqual(self.files(), files)
+        self.assertEqual(self.manifest(), manifest)
+
+        # without --refresh the local files are not even revalidated
+        results, requests = self.crawl(refresh=False)
+        self.assertEqual(results, {'present': len(PAGES)})
+        self.assertEqual(requests, [])
+
+        # one file changed on the server: only it is downloaded and rewritten
+        changed = 'book/ch1-Z-G-1.gif'
+        stat = os.stat(os.path.join(self.site, changed))
+        self.write(changed, b'GIF89a new figure', mtime=stat.st_mtime + 10)
+        results, requests = self.crawl(refresh=True)
+        self.assertEqual(results, {'downloaded': 1, 'not modified': len(PAGES) - 1})
+        self.assertEqual(requests, sorted(('/' + name, 200 if name == changed else 304)
+                                          for name in PAGES))
+        new_files = self.files()
+        with open(changed, 'rb') as f:
+            self.assertEqual(f.read(), b'GIF89a new figure')
+        self.assertNotEqual(new_files[changed], files[changed])
+        del new_files[changed], files[changed]
+        self.assertEqual(new_files, files)
+        new_manifest = self.manifest()
+        entry = new_manifest.pop(self.base_url + changed)
+        self.assertEqual(entry['sha256'], hashlib.sha256(b'GIF89a new figure').hexdigest())
+        self.assertEqual(entry['size'], len(b'GIF89a new figure'))
+        self.assertEqual(entry['etag'], '"%s"' % entry['sha256'])
+        self.assertNotEqual(entry['last_modified'], manifest[self.base_url + changed]['last_modified'])
+        del manifest[self.base_url + changed]
+        self.assertEqual(new_manifest, manifest)
+
+    def test_local_change(self):
+        '''a local file which no longer matches the manifest is fetched in full'''
+        self.crawl(refresh=False)
+        with open('book/book.css', 'wb') as f:
+            f.write(b'edited')
+        results, requests = self.crawl(refresh=True)
+        self.assertEqual(results, {'downloaded': 1, 'not modified': len(PAGES) - 1})
+        self.assertIn(('/book/book.css', 200), requests)
+        with open('book/book.css', 'rb') as f:
+            self.assertEqual(f.read(), PAGES['book/book.css'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+'''
+Check that tree.flatten and tree.unflatten give trees which are
+independent of their events and of each other.
+
+usage: python -m unittest tests/test_tree.py (from the top directory)
+'''
+
+import unittest
+from bs4 import BeautifulSoup
+
+import tree
+
+PAGE = ('<html><head><title>t</title></head><body class="main wide">'
+        '<p class="x">a <img src="ch1-Z-G-1.gif"> b</p></body></html>')
+
+class TreeTest(unittest.TestCase):
+    def test_round_trip(self):
+        soup = BeautifulSoup(PAGE, 'html5lib')
+        self.assertEqual(tree.markup(tree.unflatten(tree.flatten(soup))), str(soup))
+
+    def test_independent(self):
+        soup = BeautifulSoup(PAGE, 'html5lib')
+        events = tree.flatten(soup)
+        first, second = tree.unflatten(events), tree.unflatten(events)
+        first.img['src'] = 'ch1-Z-G-1.png'
+        first.img['style'] = 'height:1ex;'
+        first.body['class'].append('changed')
+        soup.p['class'].append('changed')
+        self.assertEqual(events, tree.flatten(BeautifulSoup(PAGE, 'html5lib')))
+        self.assertEqual(tree.markup(second), tree.markup(BeautifulSoup(PAGE, 'html5lib')))
+        self.assertEqual(tree.markup(tree.unflatten(events)), tree.markup(second))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+'''
+Build a generated book several times from one cache.MemoryCache, like
+make_epub.py --watch does, and check that a rebuild after an image
+changed gives the same epub as a fresh build: the page hooks must not
+change the transformed pages kept in memory.
+
+usage: python -m unittest tests/test_watch.py (from the top directory)
+'''
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+import PIL.Image
+
+import benchmark
+import make_epub
+from archive import ZIP_EPOCH
+from cache import MemoryCache
+
+class WatchRebuildTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        benchmark.generate(self.directory, 40)
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def build(self, output, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            make_epub.build(output, optimize_images=True, timestamp=ZIP_EPOCH, **options)
+        with open(output, 'rb') as f:
+            return f.read()
+
+    def check_rebuild(self, jobs):
+        memory = MemoryCache(None)
+        for _ in range(2):
+            self.build('watch.epub', jobs=jobs, cache=memory, freeze=True)
+        PIL.Image.new('P', (50, 300), 1).save('book/ch2-Z-G-1.gif')
+        rebuilt = self.build('watch.epub', jobs=jobs, cache=memory, freeze=True)
+        fresh = self.build('fresh.epub', jobs=jobs)
+        with zipfile.ZipFile(io.BytesIO(fresh)) as epub:
+            pages = b''.join(epub.read(name) for name in epub.namelist() if name.endswith('.xhtml'))
+        self.assertIn(b'height:48.00ex;', pages)
+        self.assertEqual(rebuilt, fresh)
+
+    def test_rebuild(self):
+        self.check_rebuild(jobs=1)
+
+    def test_rebuild_jobs(self):
+        self.check_rebuild(jobs=2)
+
+if __name__ == '__main__':
+    unittest.main()
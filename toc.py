@@ -1,100 +1,140 @@
+'''
+The table of contents of the book.
+
+Toc keeps the entries in parallel arrays (level, parent index, href and
+text by entry index) instead of a tree of objects, so a toc of tens of
+thousands of entries costs a few bytes per entry besides its strings.
+
+The ncx and xhtml documents are rendered by generators in one pass over
+the arrays and streamed into the zip file (see Medium.stream and
+ArchiveWriter.add_stream) without building the document in memory.
+'''
+
+from array import array
 from collections import namedtuple
-from itertools import count
+from functools import partial
+from xml.sax.saxutils import escape
 from media import Medium
 
 FlatTocInfo = namedtuple('FlatTocInfo', 'href, text, level')
-HierarchicalTocInfo = namedtuple('HierarchicalTocInfo', 'href, text, level, parent, children')
+
+def attribute(value):
+    '''escape value for an attribute in double quotes'''
+    return escape(value, {'"': '&quot;'})
+
+def indent(level):
+    return '      ' + '    '*level
 
 class Toc:
     def __init__(self):
-        self.entries = []
+        self.levels = array('b')
+        # index of the parent entry, -1 for the entries at level 1
+        self.parents = array('l')
+        self.hrefs = []
+        self.texts = []
 
-    def add(self, entry):
-        self.entries.append(entry)
+    def __len__(self):
+        return len(self.levels)
 
-    def hierarchical_toc_entries(self):
-        root = HierarchicalTocInfo(None, None, 0, None, [])
-        previous = root
+    def add(self, entry):
+        '''append a FlatTocInfo, entries can go down only one level at a time'''
+        previous = len(self) - 1
+        depth = self.levels[previous] if previous >= 0 else 0
+        if entry.level > 1 + depth:
+            raise ValueError('TOC entries can not skip levels')
+        parent = previous
+        while parent >= 0 and self.levels[parent] >= entry.level:
+            parent = self.parents[parent]
+        self.levels.append(entry.level)
+        self.parents.append(parent)
+        self.hrefs.append(entry.href)
+        self.texts.append(entry.text)
 
-        for item in self.entries:
-            if item.level == 1 + previous.level:
-                parent = previous
-            elif item.level > 1 + previous.level:
-                raise ValueError('TOC entries can not skip levels')
-            else:
-                while item.level < previous.level:
-                    previous = previous.parent
-                parent = previous.parent
-            new_item = HierarchicalTocInfo(item.href, item.text, item.level, parent, [])
-            parent.children.append(new_item)
-            previous = new_item
-        return root.children
+    def has_children(self, index):
+        return index + 1 < len(self) and self.parents[index + 1] == index
 
-    def ncx(self, doc):
-        lines = [
-            '<?xml version="1.0" encoding="utf-8"?>',
-            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1" xml:lang="eng">',
-            '  <head>',
-           f'    <meta content="urn:uuid:{doc.book_uuid}" name="dtb:uid"/>',
-            '    <meta content="3" name="dtb:depth"/>',
-            '    <meta content="0" name="dtb:totalPageCount"/>',
-            '    <meta content="0" name="dtb:maxPageNumber"/>',
-            '  </head>',
-           f'  <docTitle><text>{doc.title}</text></docTitle>',
-            '  <navMap>',
-        ]
+    def ncx_lines(self, title, uid):
+        '''generate the lines of the ncx document'''
+        yield from (
+            '<?xml version="1.0" encoding="utf-8"?>\n',
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1" xml:lang="eng">\n',
+            '  <head>\n',
+           f'    <meta content="urn:uuid:{uid}" name="dtb:uid"/>\n',
+            '    <meta content="3" name="dtb:depth"/>\n',
+            '    <meta content="0" name="dtb:totalPageCount"/>\n',
+            '    <meta content="0" name="dtb:maxPageNumber"/>\n',
+            '  </head>\n',
+           f'  <docTitle><text>{escape(title)}</text></docTitle>\n',
+            '  <navMap>\n',
+        )
+        depth = 0
+        for index, level in enumerate(self.levels):
+            # close the open navPoints down to the level of this entry
+            for closed in range(depth, level - 1, -1):
+                yield f'{indent(closed)}</navPoint>\n'
+            depth = level
+            ind = indent(level)
+            n = index + 1
+            yield f'{ind}<navPoint id="num_{n}" playOrder="{n}">\n'
+            yield f'{ind}  <navLabel><text>{escape(self.texts[index])}</text></navLabel>\n'
+            yield f'{ind}  <content src="{attribute(self.hrefs[index])}"/>\n'
+        for closed in range(depth, 0, -1):
+            yield f'{indent(closed)}</navPoint>\n'
+        yield '  </navMap>\n'
+        yield '</ncx>'
 
-        num = count(1)
-        def handle(entries):
-            for item in entries:
-                ind = '      ' + '    '*item.level
-                n = next(num)
-                lines.append(f'{ind}<navPoint id="num_{n}" playOrder="{n}">')
-                lines.append(f'{ind}  <navLabel><text>{item.text}</text></navLabel>')
-                lines.append(f'{ind}  <content src="{item.href}"/>')
-                if item.children:
-                    handle(item.children)
-                lines.append(f'{ind}</navPoint>')
-        handle(self.hierarchical_toc_entries())
+    def xhtml_lines(self, title):
+        '''generate the lines of the xhtml navigation document'''
+        yield from (
+            '<?xml version="1.0" encoding="utf-8"?>\n',
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n',
+            '  <head>\n',
+           f'    <title>{escape(title)}</title>\n',
+            '  </head>\n',
+            '  <body>\n',
+            '    <nav epub:type="toc">\n',
+        )
+        yield from self.list_lines()
+        yield '    </nav>\n'
+        yield '  </body>\n'
+        yield '</html>'
 
-        lines.append('  </navMap>')
-        lines.append('</ncx>')
+    def list_lines(self, link=None):
+        '''
+        generate the lines of the nested <ol> lists of the entries. if link
+        is given, the hrefs are replaced by link(href).
+        '''
+        yield '      <ol>\n'
+        depth = 0
+        for index, level in enumerate(self.levels):
+            for closed in range(depth, level - 1, -1):
+                # all open entries but the deepest one have children
+                if closed < depth:
+                    yield f'{indent(closed)}  </ol>\n'
+                yield f'{indent(closed)}</li>\n'
+            depth = level
+            ind = indent(level)
+            href = self.hrefs[index] if link is None else link(self.hrefs[index])
+            yield f'{ind}<li>\n'
+            yield f'{ind}  <a href="{attribute(href)}">{escape(self.texts[index])}</a>\n'
+            if self.has_children(index):
+                yield f'{ind}  <ol>\n'
+        for closed in range(depth, 0, -1):
+            if closed < depth:
+                yield f'{indent(closed)}  </ol>\n'
+            yield f'{indent(closed)}</li>\n'
+        yield '      </ol>\n'
 
+    def ncx(self, doc):
         return Medium(name='toc.ncx',
-                      data='\n'.join(lines),
+                      data=None,
+                      stream=partial(self.ncx_lines, doc.title, doc.book_uuid),
                       id='toc',
                       attributes={'media-type': 'application/x-dtbncx+xml'})
 
     def xhtml(self, doc):
-        lines = [
-            '<?xml version="1.0" encoding="utf-8"?>',
-            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">',
-            '  <head>',
-           f'    <title>{doc.title}</title>',
-            '  </head>',
-            '  <body>',
-            '    <nav epub:type="toc">',
-            '      <ol>',
-        ]
-
-        def handle(entries):
-            for item in entries:
-                ind = '      ' + '    '*item.level
-                lines.append(f'{ind}<li>')
-                lines.append(f'{ind}  <a href="{item.href}">{item.text}</a>')
-                if item.children:
-                    lines.append(f'{ind}  <ol>')
-                    handle(item.children)
-                    lines.append(f'{ind}  </ol>')
-                lines.append(f'{ind}</li>')
-        handle(self.hierarchical_toc_entries())
-
-        lines.append('      </ol>')
-        lines.append('    </nav>')
-        lines.append('  </body>')
-        lines.append('</html>')
-
         return Medium(name='toc.xhtml',
-                      data='\n'.join(lines),
+                      data=None,
+                      stream=partial(self.xhtml_lines, doc.title),
                       id='nav',
                       attributes={'properties': 'nav'})
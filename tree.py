@@ -0,0 +1,129 @@
+'''
+A compact, picklable representation of parsed pages.
+
+BeautifulSoup trees can not be sent between processes: pickling them
+recurses along the element chain and fails for pages of realistic size.
+flatten() turns a tree into a flat list of events in document order and
+unflatten() rebuilds an equivalent tree, which serializes to exactly the
+same markup. Both work without recursion. The events and the trees do
+not share the attributes of the tags, a tree can be changed without
+changing the events it was built from or other trees built from them.
+
+serialize() generates the markup of a tree in chunks, the same as
+str(soup) but without building the whole page in one string. bs4 finds
+the end of elements with the structural (and recursive) Tag.__eq__,
+serialize() compares the parents by identity like flatten() does. It
+uses the internal Tag._format_tag of recent bs4 versions, with older
+versions it falls back to str(soup) in one chunk.
+
+Events are
+    (TAG, name, prefix, namespace, attrs)   start of an element
+    (STRING, cls, text)                     a string of the given NavigableString class
+    END                                     end of the most recently started element
+'''
+
+from collections import namedtuple
+from itertools import chain
+from bs4 import BeautifulSoup, Tag
+from bs4.element import DEFAULT_OUTPUT_ENCODING
+
+TAG = 0
+STRING = 1
+END = None
+
+# a transformed page: the events of its tree, its table of contents
+# entries as (id, text, level) tuples, its links.PageLinks and optionally
+# the profiling.Profiler stats of the transformation
+PageResult = namedtuple('PageResult', 'events, toc, links, profile', defaults=(None,))
+
+# characters collected by serialize() before it yields a chunk
+CHUNK_SIZE = 1 << 16
+# whether serialize() can generate the markup in chunks, see above
+STREAMING = hasattr(Tag, '_format_tag')
+
+def copy_attrs(attrs):
+    '''a copy of the attributes of a tag, with copies of the multi-valued (list) attributes'''
+    return {key: list(value) if isinstance(value, list) else value for key, value in attrs.items()}
+
+def flatten(soup):
+    events = []
+    stack = [soup]
+    for node in soup.descendants:
+        while node.parent is not stack[-1]:
+            stack.pop()
+            events.append(END)
+        if isinstance(node, Tag):
+            events.append((TAG, node.name, node.prefix, node.namespace, copy_attrs(node.attrs)))
+            stack.append(node)
+        else:
+            events.append((STRING, type(node), str(node)))
+    return events
+
+def unflatten(events):
+    soup = BeautifulSoup('', 'html5lib')
+    soup.reset()
+    builder = soup.builder
+    stack = [soup]
+    for event in events:
+        if event is END:
+            stack.pop()
+        elif event[0] == TAG:
+            _, name, prefix, namespace, attrs = event
+            tag = Tag(builder=builder, name=name, prefix=prefix, namespace=namespace,
+                      attrs=copy_attrs(attrs))
+            stack[-1].append(tag)
+            stack.append(tag)
+        else:
+            _, cls, text = event
+            stack[-1].append(cls(text))
+    return soup
+
+def serialize(soup):
+    '''generate the markup of str(soup) in chunks of about CHUNK_SIZE characters'''
+    if not STREAMING:
+        yield str(soup)
+        return
+    formatter = soup.formatter_for_name('minimal')
+    pieces = ['<?xml version="1.0" encoding="utf-8"?>\n'] if soup.is_xml else []
+    size = 0
+    stack = [soup]
+    for node in soup.descendants:
+        while node.parent is not stack[-1]:
+            pieces.append(stack.pop()._format_tag(DEFAULT_OUTPUT_ENCODING, formatter, opening=False))
+        if isinstance(node, Tag):
+            piece = node._format_tag(DEFAULT_OUTPUT_ENCODING, formatter, opening=True)
+            if not node.is_empty_element:
+                stack.append(node)
+        else:
+            piece = node.output_ready(formatter)
+        pieces.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield ''.join(pieces)
+            pieces.clear()
+            size = 0
+    while len(stack) > 1:
+        pieces.append(stack.pop()._format_tag(DEFAULT_OUTPUT_ENCODING, formatter, opening=False))
+    yield ''.join(pieces)
+
+def markup(soup):
+    '''str(soup), without recursion'''
+    return ''.join(serialize(soup))
+
+def size(node):
+    '''
+    about the length of the markup of node, a Tag or a string: the tags
+    and attributes and the characters of the text, without escaping. much
+    faster than serializing.
+    '''
+    if not isinstance(node, Tag):
+        return len(node)
+    total = 0
+    for node in chain([node], node.descendants):
+        if isinstance(node, Tag):
+            total += 2 * len(node.name) + 5
+            for key, value in node.attrs.items():
+                total += len(key) + 4 + len(value if isinstance(value, str) else ' '.join(value))
+        else:
+            total += len(node)
+    return total
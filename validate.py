@@ -0,0 +1,226 @@
+'''
+A fast structural validator for the epub files written by make_epub.
+
+It checks the things the build can get wrong, without the full epubcheck:
+
+    - mimetype is the first member, stored and without extra field
+    - META-INF/container.xml points to the package document
+    - the manifest lists every member exactly once and every listed
+      member exists; the spine and the toc refer to manifest items
+    - every listed medium is used (in the spine, or referenced by a page,
+      the ncx or a stylesheet)
+    - every xml member (xhtml, ncx, opf, ...) is well-formed, its ids are
+      unique and its links point to existing members and ids
+
+The xml members are read from the zip file as streams (nothing is
+extracted) and checked in parallel worker processes with jobs > 1. The
+zip file is opened once, or once in every worker process.
+
+usage: python validate.py sicp.epub [-j N]
+'''
+
+import argparse
+import posixpath
+import re
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote, urlsplit
+from lxml import etree
+
+CONTAINER = 'META-INF/container.xml'
+MIMETYPE = b'application/epub+zip'
+OPF = '{http://www.idpf.org/2007/opf}'
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+XML_MEMBERS = ('.xhtml', '.html', '.htm', '.ncx', '.opf', '.xml', '.svg')
+CSS_URL = re.compile(rb'''url\(\s*['"]?([^'")]+)['"]?\s*\)''')
+
+class InvalidEpub(Exception):
+    def __init__(self, problems):
+        super().__init__(f'{len(problems)} problems found in the epub')
+        self.problems = problems
+
+def resolve(base, url):
+    '''the member name and fragment url refers to from the member base, member is None for external urls'''
+    parts = urlsplit(url)
+    if parts.scheme or parts.netloc:
+        return None, parts.fragment
+    if not parts.path:
+        return base, parts.fragment
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base), unquote(parts.path))), parts.fragment
+
+# the epub opened by each worker process, see open_archive()
+worker_archive = None
+
+def open_archive(path):
+    '''the initializer of the worker processes: open the epub file path once per process'''
+    global worker_archive
+    worker_archive = zipfile.ZipFile(path)
+
+def check_member(name, archive=None):
+    '''
+    parse the xml member name of the open epub archive (the one of the
+    worker process by default), returning the problems, the ids (None if
+    it is not well-formed) and the (url, line) references found in it
+    '''
+    archive = archive or worker_archive
+    with archive.open(name) as member:
+        try:
+            root = etree.parse(member).getroot()
+        except etree.XMLSyntaxError as error:
+            return [f'{name}: not well-formed xml: {error}'], None, []
+    problems = []
+    ids = set()
+    references = []
+    for el in root.iter(etree.Element):
+        id_ = el.get('id')
+        if id_ is not None:
+            if id_ in ids:
+                problems.append(f'{name}:{el.sourceline}: duplicate id {id_}')
+            ids.add(id_)
+        for attr in ('href', 'src', XLINK_HREF):
+            if el.get(attr) is not None:
+                references.append((el.get(attr), el.sourceline))
+    return problems, sorted(ids), references
+
+def check_css(name, archive=None):
+    '''return the (url, line) references of the stylesheet member name'''
+    data = (archive or worker_archive).read(name)
+    return [(match.group(1).decode('utf-8', 'replace'), data.count(b'\n', 0, match.start()) + 1)
+            for match in CSS_URL.finditer(data)]
+
+def check_mimetype(infos):
+    if not infos or infos[0].filename != 'mimetype':
+        return ['mimetype is not the first member']
+    info = infos[0]
+    problems = []
+    if info.compress_type != zipfile.ZIP_STORED:
+        problems.append('mimetype is compressed')
+    if info.extra:
+        problems.append('mimetype has an extra field')
+    return problems
+
+def package(archive, names):
+    '''return the name of the package document and the problems finding it'''
+    if CONTAINER not in names:
+        return None, [f'{CONTAINER} is missing']
+    try:
+        container = etree.fromstring(archive.read(CONTAINER))
+    except etree.XMLSyntaxError as error:
+        return None, [f'{CONTAINER}: not well-formed xml: {error}']
+    rootfile = container.find('.//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile')
+    if rootfile is None or not rootfile.get('full-path'):
+        return None, [f'{CONTAINER}: no rootfile']
+    opf = rootfile.get('full-path')
+    if opf not in names:
+        return None, [f'{CONTAINER}: the package document {opf} is missing']
+    return opf, []
+
+def validate(path, jobs=1):
+    '''validate the epub file path and return the list of problems found'''
+    with zipfile.ZipFile(path) as archive:
+        infos = archive.infolist()
+        names = [info.filename for info in infos]
+        problems = check_mimetype(infos)
+        if 'mimetype' in names and archive.read('mimetype') != MIMETYPE:
+            problems.append('mimetype has the wrong content')
+        for name in set(names):
+            if names.count(name) > 1:
+                problems.append(f'{name}: stored more than once')
+        opf, found = package(archive, names)
+        problems += found
+        if opf is None:
+            return problems
+        try:
+            root = etree.fromstring(archive.read(opf))
+        except etree.XMLSyntaxError as error:
+            return problems + [f'{opf}: not well-formed xml: {error}']
+
+    items = {}
+    used = set()
+    for item in root.iter(OPF + 'item'):
+        id_, href = item.get('id'), item.get('href')
+        member, _ = resolve(opf, href or '')
+        if id_ in items:
+            problems.append(f'{opf}: duplicate manifest id {id_}')
+        items[id_] = member
+        if member not in names:
+            problems.append(f'{opf}: manifest item {href} is missing')
+        if set(item.get('properties', '').split()) & {'nav', 'cover-image'}:
+            used.add(member)
+    listed = set(items.values())
+    for name in names:
+        if name not in listed and name not in ('mimetype', opf) and not name.startswith('META-INF/'):
+            problems.append(f'{name}: not listed in the manifest')
+
+    spine = root.find(OPF + 'spine')
+    if spine is None:
+        problems.append(f'{opf}: no spine')
+    else:
+        toc = spine.get('toc')
+        if toc is not None:
+            if toc not in items:
+                problems.append(f'{opf}: the spine toc {toc} is not in the manifest')
+            used.add(items.get(toc))
+        for itemref in spine.iter(OPF + 'itemref'):
+            idref = itemref.get('idref')
+            if idref not in items:
+                problems.append(f'{opf}: spine item {idref} is not in the manifest')
+            used.add(items.get(idref))
+    for meta in root.iter(OPF + 'meta'):
+        if meta.get('name') == 'cover':
+            if meta.get('content') not in items:
+                problems.append(f'{opf}: the cover {meta.get("content")} is not in the manifest')
+            used.add(items.get(meta.get('content')))
+
+    xml_members = [name for name in names if name.endswith(XML_MEMBERS) and name != opf]
+    css_members = [name for name in names if name.endswith('.css')]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=open_archive, initargs=(path,)) as pool:
+            results = list(pool.map(check_member, xml_members, chunksize=8))
+            css_results = list(pool.map(check_css, css_members))
+    else:
+        with zipfile.ZipFile(path) as archive:
+            results = [check_member(name, archive) for name in xml_members]
+            css_results = [check_css(name, archive) for name in css_members]
+
+    ids = {}
+    references = []
+    for name, (found, member_ids, member_references) in zip(xml_members, results):
+        problems += found
+        if member_ids is not None:
+            ids[name] = set(member_ids)
+        references += [(name, url, line) for url, line in member_references]
+    for name, css_references in zip(css_members, css_results):
+        references += [(name, url, line) for url, line in css_references]
+
+    existing = set(names)
+    for name, url, line in references:
+        member, fragment = resolve(name, url)
+        if member is None:
+            continue
+        used.add(member)
+        if member not in existing:
+            problems.append(f'{name}:{line}: link to missing member {url}')
+        elif fragment and member in ids and fragment not in ids[member]:
+            problems.append(f'{name}:{line}: link to missing id {url}')
+    for member in sorted(listed - used):
+        if member in existing:
+            problems.append(f'{member}: listed in the manifest but not used')
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the structure of an epub file.')
+    parser.add_argument('epub')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of worker processes checking the members (default: %(default)s)')
+    args = parser.parse_args()
+    problems = validate(args.epub, jobs=args.jobs)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(f'{len(problems)} problems found in {args.epub}')
+    print(f'{args.epub}: no problems found')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+'''
+Find the files which changed, for make_epub.py --watch.
+
+The files are polled: a snapshot holds the size and mtime of every
+watched file, and a change is reported once two snapshots in a row agree
+(editors often write a file in several steps). Polling needs nothing
+beyond the standard library and a snapshot of the book takes a few
+milliseconds.
+'''
+
+import os
+import time
+
+# the directories of the sources of the book
+WATCHED = ('book', 'new_content')
+# seconds between two snapshots
+POLL_INTERVAL = 0.25
+
+def snapshot(directories, files=()):
+    '''the (size, mtime_ns) of the files below directories and of files, by path'''
+    paths = list(files)
+    for directory in directories:
+        for root, _, names in os.walk(directory):
+            paths += [os.path.join(root, name) for name in names]
+    result = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        result[path] = (stat.st_size, stat.st_mtime_ns)
+    return result
+
+def changes(old, new):
+    '''the paths which were added, removed or modified between the snapshots old and new'''
+    return sorted(path for path in old.keys() | new.keys() if old.get(path) != new.get(path))
+
+def wait_for_changes(take, previous, interval=POLL_INTERVAL):
+    '''
+    poll take(), a function returning a snapshot, until it differs from the
+    snapshot previous and stays the same for one interval. returns the new
+    snapshot and the changed paths.
+    '''
+    while True:
+        time.sleep(interval)
+        current = take()
+        if current == previous:
+            continue
+        while True:
+            time.sleep(interval)
+            settled = take()
+            if settled == current:
+                return current, changes(previous, current)
+            current = settled